@@ -0,0 +1,131 @@
+"""Micro-benchmark for query.py: p50 / p99 latency of slice queries, with
+and without the LRU cache, against reading the whole table and filtering.
+
+    python -m benchmarks.query data.h5 --table department_product_year
+    python -m benchmarks.query --scale medium
+
+Without a data path, a synthetic data.h5 is built first (see benchmarks.run)."""
+
+import os
+import time
+import shutil
+import tempfile
+
+import numpy as np
+
+import input_cache
+import output
+import query
+from dataset_tools import good, warn
+
+
+def percentiles(latencies):
+    latencies = np.asarray(latencies) * 1000.0
+    return np.percentile(latencies, 50), np.percentile(latencies, 99)
+
+
+def report(name, latencies):
+    p50, p99 = percentiles(latencies)
+    print("{:30} p50 {:9.3f}ms  p99 {:9.3f}ms  ({} queries)".format(
+        name, p50, p99, len(latencies)))
+
+
+def random_slices(data_path, table, column, num_queries, seed=0):
+    """(id, year) slices of a table to query, skewed towards some ids like
+    real traffic (Zipf distributed ranks)."""
+    data = output.open_output(data_path, mode="r")
+    try:
+        keys = data.read(table, columns=[column, "year"]).drop_duplicates()
+    finally:
+        data.close()
+
+    random = np.random.RandomState(seed)
+    ranks = np.minimum(random.zipf(1.5, size=num_queries), len(keys)) - 1
+    order = random.permutation(len(keys))
+    picked = keys.iloc[order[ranks]]
+    return [{column: int(row[0]), "year": int(row[1])}
+            for row in picked.itertuples(index=False)]
+
+
+def time_queries(q, table, slices):
+    latencies = []
+    for filters in slices:
+        start = time.perf_counter()
+        q.slice(table, **filters)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def run_benchmark(data_path, table, column, num_queries, cache_dir):
+    slices = random_slices(data_path, table, column, num_queries)
+
+    # Building the sorted copies happens on the first query of a table
+    q = query.FacetQuery(data_path, cache_dir=cache_dir, cache_bytes=0)
+    start = time.perf_counter()
+    q.slice(table, **slices[0])
+    good("Indexed {} in {:.3f}s.".format(table, time.perf_counter() - start))
+
+    report("uncached slice", time_queries(q, table, slices))
+
+    q = query.FacetQuery(data_path, cache_dir=cache_dir)
+    latencies = time_queries(q, table, slices)
+    report("LRU cached slice", latencies)
+    print("{:30} {:.1%}".format("cache hit rate",
+                                q.cache.hits / max(q.cache.hits + q.cache.misses, 1)))
+
+    # What the API has to do without the query module
+    data = output.open_output(data_path, mode="r")
+    try:
+        latencies = []
+        for filters in slices[:min(len(slices), 20)]:
+            start = time.perf_counter()
+            df = data.read(table)
+            mask = np.ones(len(df), dtype=bool)
+            for c, v in filters.items():
+                mask &= df[c].values == v
+            df[mask]
+            latencies.append(time.perf_counter() - start)
+        report("whole table read", latencies)
+    finally:
+        data.close()
+
+
+def build_synthetic(scale_name, directory):
+    from benchmarks import run
+    import pipeline
+
+    datasets, tables = run.synthetic_setup(run.SCALES[scale_name],
+                                           os.path.join(directory, "inputs"))
+    data_path = os.path.join(directory, "data.h5")
+    pipeline.run_pipeline(datasets, tables, data_path)
+    return data_path
+
+
+if __name__ == "__main__":
+    import argparse
+    from benchmarks.run import SCALES
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("data", nargs="?", default=None,
+                        help="data.h5 or a Parquet output directory to query")
+    parser.add_argument("--scale", default="small", choices=sorted(SCALES),
+                        help="Size of the synthetic data to build if no data is given")
+    parser.add_argument("--table", default="department_product_year")
+    parser.add_argument("--column", default="location_id",
+                        help="Id column to slice by (default: location_id)")
+    parser.add_argument("-n", "--queries", type=int, default=1000)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="peru-query-bench-")
+    try:
+        data_path = args.data
+        if data_path is None:
+            input_cache.CACHE_ENABLED = False
+            data_path = build_synthetic(args.scale, workdir)
+        elif args.scale != "small":
+            warn("Ignoring --scale, querying {}.".format(data_path))
+
+        run_benchmark(data_path, args.table, args.column, args.queries,
+                      os.path.join(workdir, "query-cache"))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
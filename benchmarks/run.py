@@ -0,0 +1,239 @@
+"""Benchmark the ingestion and downloads pipelines end to end on synthetic
+data, at several scales, and compare against stored baselines.
+
+    python -m benchmarks.run --scales small medium
+    python -m benchmarks.run --scales small --save-baseline
+
+Runs offline: inputs are generated into a scratch directory, nothing is read
+from NFS.
+
+Baselines are stored per scale in benchmarks/baselines/<scale>.json. The
+committed ones were recorded with the default --repeat on a development
+machine, so re-save them with --save-baseline on different hardware. A
+scale without a baseline can't be checked for regressions, which fails the
+run."""
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+
+import dataset_tools
+import input_cache
+import output
+from dataset_tools import good, bad
+from download_tools import DownloadEngine, write_workbook, write_csv_gzip
+
+from benchmarks import synthetic
+
+
+SCALES = {
+    "small": {
+        "departments": 5,
+        "provinces_per_department": 2,
+        "products": 20,
+        "partners": 10,
+        "years": [2010, 2011],
+        "density": 0.5,
+    },
+    "medium": {
+        "departments": 10,
+        "provinces_per_department": 3,
+        "products": 100,
+        "partners": 30,
+        "years": [2010, 2011, 2012],
+        "density": 0.3,
+    },
+    "large": {
+        "departments": 25,
+        "provinces_per_department": 3,
+        "products": 200,
+        "partners": 40,
+        "years": [2010, 2011, 2012],
+        "density": 0.2,
+    },
+}
+
+BASELINE_DIR = os.path.join(os.path.dirname(__file__), "baselines")
+
+# Slower than baseline by more than this fraction counts as a regression
+DEFAULT_TOLERANCE = 0.2
+
+# ... unless it's slower by less than this many seconds, which is noise
+MIN_REGRESSION_SECONDS = 0.05
+
+# Runs per scale, keeping the fastest timings. The first run in a process
+# pays one-off warm up costs (e.g. on the first HDF write).
+DEFAULT_REPEAT = 3
+
+
+def timed(timings, name, f, *args, **kwargs):
+    start = time.time()
+    result = f(*args, **kwargs)
+    timings[name] = time.time() - start
+    return result
+
+
+def synthetic_setup(scale, directory):
+    """Synthetic versions of datasets.DATASETS and datasets.TABLES."""
+    import datasets
+
+    classifications = {
+        datasets.location_classification: synthetic.location_classification(
+            scale["departments"], scale["provinces_per_department"]),
+        datasets.product_classification: synthetic.product_classification(
+            scale["products"]),
+        datasets.country_classification: synthetic.country_classification(
+            scale["partners"]),
+    }
+
+    synthetic_datasets = synthetic.synthetic_datasets(
+        datasets.DATASETS, directory, classifications, scale["years"],
+        density=scale["density"])
+
+    classification_tables = {
+        "/classifications/product": datasets.product_classification,
+        "/classifications/location": datasets.location_classification,
+        "/classifications/country": datasets.country_classification,
+    }
+    synthetic_tables = {}
+    for table_name, table in datasets.TABLES.items():
+        table = dict(table)
+        if table_name in classification_tables:
+            stand_in = classifications[classification_tables[table_name]]
+            table["build_function"] = \
+                lambda results, stand_in=stand_in: stand_in.table.reset_index()
+        synthetic_tables[table_name] = table
+
+    return synthetic_datasets, synthetic_tables
+
+
+def run_scale(scale, directory):
+    """Time processing each dataset, writing data.h5 and generating each
+    download. Returns {benchmark name: seconds}."""
+    import downloads
+    from pipeline import build_table, table_layout
+
+    timings = {}
+    datasets, tables = synthetic_setup(scale, os.path.join(directory, "inputs"))
+
+    results = {}
+    for name, dataset in sorted(datasets.items()):
+        results[name] = timed(timings, "process:" + name,
+                              dataset_tools.process_dataset, dataset)
+
+    data_path = os.path.join(directory, "data.h5")
+    if os.path.exists(data_path):
+        os.remove(data_path)
+
+    def write_all():
+        out = output.open_output(data_path)
+        try:
+            for table_name, table in tables.items():
+                out.write(table_name, build_table(table, results),
+                          table.get("attrs", {}), table_layout(table, datasets))
+        finally:
+            out.close()
+    timed(timings, "write_hdf", write_all)
+
+    downloads_dir = os.path.join(directory, "downloads")
+    os.makedirs(downloads_dir, exist_ok=True)
+
+    engine = DownloadEngine(data_path)
+    timed(timings, "downloads:prepare", engine.prepare,
+          list(downloads.DOWNLOADS.values()))
+    for name, spec in sorted(downloads.DOWNLOADS.items()):
+        timed(timings, "downloads:" + name, write_workbook,
+              os.path.join(downloads_dir, name + ".xlsx"), engine.frames(spec))
+        timed(timings, "downloads_csv:" + name, write_csv_gzip,
+              os.path.join(downloads_dir, name + ".csv"), engine.frames(spec))
+    engine.close()
+
+    timings["total"] = sum(timings.values())
+    return timings
+
+
+def compare(timings, baseline, tolerance):
+    """Names of benchmarks that got slower than baseline beyond tolerance."""
+    regressions = []
+    for name, seconds in sorted(timings.items()):
+        if name not in baseline:
+            continue
+        if seconds > baseline[name] * (1 + tolerance) and \
+                seconds - baseline[name] > MIN_REGRESSION_SECONDS:
+            regressions.append(name)
+    return regressions
+
+
+def baseline_path(scale_name):
+    return os.path.join(BASELINE_DIR, scale_name + ".json")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--scales", nargs="+", default=["small"],
+                        choices=sorted(SCALES))
+    parser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT,
+                        help="Run each scale this many times and keep the fastest timings "
+                             "(default: {})".format(DEFAULT_REPEAT))
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE)
+    parser.add_argument("--save-baseline", action="store_true",
+                        help="Store these timings as the new baselines")
+    parser.add_argument("--workdir", default=None,
+                        help="Keep generated inputs and outputs here instead of a temp dir")
+    args = parser.parse_args()
+
+    # Measure parsing too, not the local cache
+    input_cache.CACHE_ENABLED = False
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="peru-bench-")
+    failed = False
+
+    try:
+        for scale_name in args.scales:
+            directory = os.path.join(workdir, scale_name)
+
+            timings = {}
+            for _ in range(args.repeat):
+                run = run_scale(SCALES[scale_name], directory)
+                for name, seconds in run.items():
+                    timings[name] = min(seconds, timings.get(name, seconds))
+
+            good("Scale {}:".format(scale_name))
+            baseline = {}
+            if os.path.exists(baseline_path(scale_name)):
+                with open(baseline_path(scale_name)) as f:
+                    baseline = json.load(f)
+
+            for name, seconds in sorted(timings.items()):
+                if name in baseline:
+                    print("{:45} {:8.3f}s  (baseline {:8.3f}s)".format(
+                        name, seconds, baseline[name]))
+                else:
+                    print("{:45} {:8.3f}s".format(name, seconds))
+
+            if args.save_baseline:
+                os.makedirs(BASELINE_DIR, exist_ok=True)
+                with open(baseline_path(scale_name), "w") as f:
+                    json.dump(timings, f, indent=2, sort_keys=True)
+                good("Saved baseline for {}.".format(scale_name))
+            elif not baseline:
+                bad("No baseline for scale {} at {}, so it wasn't checked for "
+                    "regressions. Record one with --save-baseline."
+                    .format(scale_name, baseline_path(scale_name)))
+                failed = True
+            else:
+                regressions = compare(timings, baseline, args.tolerance)
+                for name in regressions:
+                    bad("Regression in {}: {:.3f}s vs {:.3f}s baseline".format(
+                        name, timings[name], baseline[name]))
+                failed = failed or bool(regressions)
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,155 @@
+"""Synthetic stand ins for the Peru inputs: classifications shaped like the
+linnaeus ones and .dta files with the same columns as each dataset in
+datasets.py, at configurable sizes."""
+
+import os
+import copy
+import itertools
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+
+class SyntheticClassification(object):
+    """Stand in for a linnaeus classification, a table indexed by id with
+    code, name, name_es, level and parent_id columns."""
+
+    def __init__(self, table):
+        self.table = table
+
+    @property
+    def source_hash(self):
+        """Hash of the table, so that fingerprints.config_token() can
+        describe it like a CachedClassification."""
+        return str(pd.util.hash_pandas_object(self.table).sum())
+
+    def level(self, level):
+        return self.table[self.table.level == level]
+
+
+def _classification(rows):
+    table = pd.DataFrame(rows, columns=["code", "name", "name_es", "level",
+                                        "parent_id"])
+    table.index.name = "index"
+    return SyntheticClassification(table)
+
+
+def location_classification(departments, provinces_per_department):
+    rows = [("000000", "Peru", "Perú", "country", np.nan)]
+    for d in range(1, departments + 1):
+        department_id = len(rows)
+        rows.append(("{:02d}0000".format(d), "Department {}".format(d),
+                     "Departamento {}".format(d), "department", 0))
+        for p in range(1, provinces_per_department + 1):
+            rows.append(("{:02d}{:02d}00".format(d, p),
+                         "Province {}-{}".format(d, p),
+                         "Provincia {}-{}".format(d, p), "msa", department_id))
+    return _classification(rows)
+
+
+def product_classification(products):
+    return _classification([
+        ("{:04d}".format(100 + i), "Product {}".format(i),
+         "Producto {}".format(i), "4digit", np.nan)
+        for i in range(products)
+    ])
+
+
+def country_classification(partners):
+    letters = "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+    codes = ["".join(c) for c in
+             itertools.islice(itertools.product(letters, repeat=3), partners)]
+    return _classification([
+        (code, "Country {}".format(code), "País {}".format(code), "country",
+         np.nan)
+        for code in codes
+    ])
+
+
+# Length of the location codes in the source files at each level, before the
+# dataset hooks pad them out to 6 digits
+SOURCE_CODE_LENGTH = {
+    "country": 6,
+    "department": 2,
+    "msa": 4,
+}
+
+
+def source_codes(classification, level, target):
+    codes = classification.level(level).code
+    if target == "location":
+        codes = codes.str[:SOURCE_CODE_LENGTH[level]]
+    return codes.unique()
+
+
+def generate_dataset_frame(dataset, years, density=1.0, seed=0):
+    """A frame with the source columns of a dataset dict: every combination
+    of its entity codes and years (a random density fraction of them) with
+    random values for everything else."""
+    random = np.random.RandomState(seed)
+
+    entity_columns = []
+    entity_values = []
+    value_columns = []
+    for source, target in dataset["field_mapping"].items():
+        if target in dataset["classification_fields"]:
+            c = dataset["classification_fields"][target]
+            entity_columns.append(source)
+            entity_values.append(
+                source_codes(c["classification"], c["level"], target))
+        elif target == "year":
+            entity_columns.append(source)
+            entity_values.append(np.array(years, dtype=np.int16))
+        else:
+            value_columns.append(source)
+
+    grids = np.meshgrid(*[np.arange(len(v)) for v in entity_values],
+                        indexing="ij")
+    df = pd.DataFrame(OrderedDict(
+        (column, values[grid.ravel()])
+        for column, values, grid in zip(entity_columns, entity_values, grids)
+    ))
+    if density < 1.0:
+        df = df[random.rand(len(df)) < density].reset_index(drop=True)
+
+    for column in value_columns:
+        df[column] = random.lognormal(size=len(df))
+
+    for column in entity_columns:
+        if df[column].dtype == object:
+            df[column] = df[column].astype(str)
+
+    return df
+
+
+def synthetic_datasets(datasets, directory, classifications, years,
+                       density=1.0):
+    """Copy dataset dicts to read generated .dta files in directory and use
+    the synthetic classifications, which is a dict from the real
+    classification objects to their stand ins. Datasets with a partner
+    country are thinned to density, like the real sparse rcpy data."""
+    os.makedirs(directory, exist_ok=True)
+
+    synthetic = {}
+    for seed, (name, dataset) in enumerate(sorted(datasets.items())):
+        dataset = copy.copy(dataset)
+        dataset["classification_fields"] = {
+            field: {
+                "classification": classifications[c["classification"]],
+                "level": c["level"],
+            }
+            for field, c in dataset["classification_fields"].items()
+        }
+
+        path = os.path.join(directory, name + ".dta")
+        if not os.path.exists(path):
+            dataset_density = density if "country" in dataset["facet_fields"] else 1.0
+            df = generate_dataset_frame(dataset, years,
+                                        density=dataset_density, seed=seed)
+            df.to_stata(path, write_index=False)
+
+        dataset["source_file"] = path
+        dataset.pop("read_function", None)
+        synthetic[name] = dataset
+    return synthetic
@@ -0,0 +1,221 @@
+"""Classifications loaded through a disk cache keyed on the hash of their
+source CSV, with a memoized (and persisted) index of each level. Loading is
+lazy, so importing a module that declares classifications costs nothing
+until one of them is actually used."""
+
+import os
+import json
+import pickle
+import hashlib
+from collections import namedtuple
+
+import pandas as pd
+
+from input_cache import atomic_write, source_fingerprint
+
+
+CACHE_DIR = os.environ.get(
+    "PERU_INGESTION_CLASSIFICATION_CACHE_DIR",
+    os.path.join(os.path.expanduser("~"), ".cache", "peru-ingestion",
+                 "classifications"))
+
+
+# The level table (code, names, parent etc. indexed by id) along with the
+# precomputed code -> id lookup used to merge ids into datasets.
+LevelIndex = namedtuple("LevelIndex", ["table", "lookup"])
+
+
+def find_source_file(path):
+    """Locate the CSV that linnaeus loads for a classification path."""
+    import linnaeus
+
+    if os.path.isabs(path):
+        return path if os.path.exists(path) else None
+
+    package_dir = os.path.dirname(linnaeus.__file__)
+    for base in [package_dir,
+                 os.path.join(package_dir, "data"),
+                 os.path.join(package_dir, "..")]:
+        candidate = os.path.join(base, path)
+        if os.path.exists(candidate):
+            return candidate
+    return None
+
+
+def linnaeus_version():
+    """Version of the installed linnaeus distribution, with the commit it was
+    installed from if that was git. None if it can't be found."""
+    try:
+        from importlib import metadata
+    except ImportError:
+        return None
+
+    try:
+        distribution = metadata.distribution("linnaeus")
+    except metadata.PackageNotFoundError:
+        return None
+
+    version = distribution.version
+    direct_url = distribution.read_text("direct_url.json")
+    if direct_url:
+        commit = json.loads(direct_url).get("vcs_info", {}).get("commit_id")
+        if commit:
+            version += "+" + commit
+    return version
+
+
+def source_hash(path):
+    """Hash of the source CSV of a classification. If the CSV can't be found
+    fall back to the installed linnaeus version, which pins the
+    classification data, or None if that's unknown too. The hash is
+    remembered while the CSV's size and mtime don't change."""
+    source_file = find_source_file(path)
+    if source_file is not None:
+        return source_fingerprint(source_file)
+
+    version = linnaeus_version()
+    if version is None:
+        return None
+    return hashlib.sha1(
+        "{}:{}".format(version, path).encode("utf-8")).hexdigest()
+
+
+def table_hash(table):
+    """Hash of the contents of a classification table."""
+    return hashlib.sha1(
+        pd.util.hash_pandas_object(table).values.tobytes()).hexdigest()
+
+
+def _read_pickle(path):
+    with open(path, "rb") as f:
+        return pickle.load(f)
+
+
+def _write_pickle(path, obj):
+    def write(tmp_path):
+        with open(tmp_path, "wb") as f:
+            pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+    atomic_write(path, write)
+
+
+def classification_lookup(classification_table):
+    """Precompute the code -> id lookup for a classification level, as a
+    hashed index of codes and the array of ids in the same order."""
+    return (pd.Index(classification_table.code.values),
+            classification_table.index.values)
+
+
+def build_level_index(classification, level):
+    table = classification.level(level)
+    return LevelIndex(table, classification_lookup(table))
+
+
+class CachedClassification(object):
+    """A handle on a linnaeus classification that loads it from the pickle
+    cache on first use, computes each level index once per process and
+    persists it between runs. Anything else is passed through to the
+    underlying classification.
+
+    Nothing is read when the handle is created. Level indexes come straight
+    from their own cache files, so a warm run that only merges codes never
+    unpickles (let alone parses) the whole classification."""
+
+    def __init__(self, path, cache_dir=None):
+        self.path = path
+        self.cache_dir = cache_dir or CACHE_DIR
+        self._source_hash = None
+        self._classification = None
+        self._levels = {}
+
+    def __getattr__(self, name):
+        # Only called for attributes not found normally. Guard against
+        # recursion when unpickling before the instance dict is set.
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self.classification, name)
+
+    def __repr__(self):
+        return "CachedClassification({!r})".format(self.path)
+
+    @property
+    def source_hash(self):
+        if self._source_hash is None:
+            self._source_hash = source_hash(self.path)
+            if self._source_hash is None:
+                # Nothing pins the classification data, so it has to be
+                # loaded to tell whether the cache is stale
+                self._classification = self._load()
+                self._source_hash = table_hash(self._classification.table)
+        return self._source_hash
+
+    def _cache_file(self, suffix=""):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        return os.path.join(self.cache_dir, self.source_hash + suffix + ".pkl")
+
+    @property
+    def classification(self):
+        if self._classification is None:
+            cache_file = self._cache_file()
+            if self._classification is not None:
+                # Loaded by source_hash just now
+                if not os.path.exists(cache_file):
+                    _write_pickle(cache_file, self._classification)
+            elif os.path.exists(cache_file):
+                self._classification = _read_pickle(cache_file)
+            else:
+                self._classification = self._load()
+                _write_pickle(cache_file, self._classification)
+        return self._classification
+
+    def _load(self):
+        from linnaeus import classification as linnaeus_classification
+        return linnaeus_classification.load(self.path)
+
+    @property
+    def table(self):
+        return self.classification.table
+
+    def level_index(self, level):
+        if level not in self._levels:
+            cache_file = self._cache_file("-level-{}".format(level))
+            if os.path.exists(cache_file):
+                self._levels[level] = LevelIndex(*_read_pickle(cache_file))
+            else:
+                self._levels[level] = build_level_index(self.classification,
+                                                        level)
+                _write_pickle(cache_file, tuple(self._levels[level]))
+        return self._levels[level]
+
+    def level(self, level):
+        return self.level_index(level).table
+
+
+def load(path):
+    """Drop in replacement for linnaeus.classification.load, that doesn't
+    load anything until the classification is used."""
+    return CachedClassification(path)
+
+
+# Level indexes of classifications that didn't come from load(), by id()
+_uncached_levels = {}
+
+
+def level_index(classification, level):
+    """Level table and code -> id lookup for a classification level,
+    computed once per process."""
+    if isinstance(classification, CachedClassification):
+        return classification.level_index(level)
+
+    key = (id(classification), level)
+    if key not in _uncached_levels:
+        _uncached_levels[key] = build_level_index(classification, level)
+    return _uncached_levels[key]
+
+
+def warm(datasets):
+    """Compute the level indexes used by the given datasets up front, so that
+    worker processes forked afterwards share them instead of each building
+    their own."""
+    for dataset in datasets.values():
+        for c in dataset.get("classification_fields", {}).values():
+            level_index(c["classification"], c["level"])
@@ -0,0 +1,100 @@
+"""Shrink the dtypes of a dataset's columns: small integer types for years
+and ids, categoricals for codes and optionally float32 for metrics.
+
+Which columns get which dtype is a dict of column names or fnmatch patterns
+to one of:
+
+    "category"   categorical, for codes with few distinct values
+    "unsigned"   the smallest unsigned integer type that fits the values
+    "integer"    the smallest signed integer type that fits the values
+    "float32"    float32, if it's within the float tolerance of the values
+    anything else is passed to astype(), e.g. "int16"
+    None         leave the column alone
+
+The first matching entry wins, exact names before patterns. Columns with
+missing values are never converted to integers."""
+
+import fnmatch
+
+import numpy as np
+import pandas as pd
+
+
+# Maximum relative error allowed when converting metrics to float32
+DEFAULT_FLOAT_TOLERANCE = 1e-6
+
+
+def column_dtype(column, dtypes):
+    """The dtype a column should be compacted to, None if it should be left
+    alone."""
+    if column in dtypes:
+        return dtypes[column]
+    for pattern, dtype in dtypes.items():
+        if fnmatch.fnmatchcase(column, pattern):
+            return dtype
+    return None
+
+
+def _fits(series, dtype):
+    info = np.iinfo(dtype)
+    return series.min() >= info.min and series.max() <= info.max
+
+
+def float32_error(series):
+    """Maximum relative error of a column converted to float32."""
+    values = series.values.astype(np.float64)
+    converted = values.astype(np.float32).astype(np.float64)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        error = np.abs(converted - values) / np.abs(values)
+    # Exact zeros divide to nan and missing values stay missing
+    error[(values == 0) & (converted == 0)] = 0
+    error[np.isnan(values) & np.isnan(converted)] = 0
+    return float(np.nanmax(np.where(np.isnan(error), np.inf, error))) \
+        if len(error) else 0.0
+
+
+def compact_column(series, dtype, float_tolerance=DEFAULT_FLOAT_TOLERANCE):
+    """Convert one column, or return None if it can't be converted
+    without losing information."""
+    if series.dtype.name == dtype:
+        return series
+
+    if dtype == "category":
+        return series.astype("category")
+
+    if dtype == "float32":
+        if not pd.api.types.is_numeric_dtype(series):
+            return None
+        if float32_error(series) > float_tolerance:
+            return None
+        return series.astype(np.float32)
+
+    if dtype in ("integer", "unsigned") or \
+            pd.api.types.is_integer_dtype(np.dtype(dtype)):
+        if not pd.api.types.is_numeric_dtype(series) or series.isnull().any():
+            return None
+        if not (series == series.round()).all():
+            return None
+        if dtype in ("integer", "unsigned"):
+            return pd.to_numeric(series, downcast=dtype)
+        if len(series) and not _fits(series, np.dtype(dtype)):
+            return None
+        return series.astype(dtype)
+
+    return series.astype(dtype)
+
+
+def compact(df, dtypes, float_tolerance=DEFAULT_FLOAT_TOLERANCE):
+    """Compact the columns of df according to dtypes. Returns the new frame
+    and a list of (column, dtype) conversions that had to be skipped."""
+    skipped = []
+    for column in df.columns:
+        dtype = column_dtype(column, dtypes)
+        if dtype is None:
+            continue
+        converted = compact_column(df[column], dtype, float_tolerance)
+        if converted is None:
+            skipped.append((column, dtype))
+        elif converted is not df[column]:
+            df[column] = converted
+    return df, skipped
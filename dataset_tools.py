@@ -1,58 +1,233 @@
+import os
+import concurrent.futures
+
 import pandas as pd
 import numpy as np
 
 from atlas_core.helpers.data_import import translate_columns
-from reckoner import assertions
-
 from clint.textui import puts, indent, colored
+from collections import OrderedDict
 from io import StringIO
 
+import compaction
+import input_cache
+import validation
+from validation import factorize_codes
+from instrumentation import stage
+from classification_cache import classification_lookup, level_index
+
+
+# Classification table columns and the model attributes they're stored in.
+# Tables don't always have the optional ones.
+MODEL_COLUMNS = OrderedDict([
+    ("code", "code"),
+    ("name", "name_en"),
+    ("name_es", "name_es"),
+    ("name_short_en", "name_short_en"),
+    ("name_short_es", "name_short_es"),
+    ("description_es", "description_es"),
+    ("description_en", "description_en"),
+    ("level", "level"),
+    ("parent_id", "parent_id"),
+])
+REQUIRED_MODEL_COLUMNS = ["code", "name", "level", "parent_id"]
+
+
+def classification_to_records(classification, batch_size=None):
+    """Rows of a classification as dicts of model attributes, ready for a
+    bulk insert. The table is converted column by column once, with missing
+    values as None. With a batch_size, yields lists of that many dicts
+    instead of single dicts."""
+    table = classification.table
+    columns = [c for c in MODEL_COLUMNS
+               if c in REQUIRED_MODEL_COLUMNS or c in table.columns]
+
+    keys = ["id"] + [MODEL_COLUMNS[c] for c in columns]
+    values = [table.index.tolist()]
+    for column in columns:
+        series = table[column]
+        values.append(series.astype(object).where(series.notnull(), None).tolist())
+
+    records = (dict(zip(keys, row)) for row in zip(*values))
+    if batch_size is None:
+        return records
+    return _batches(records, batch_size)
+
+
+def _batches(iterable, batch_size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _record_to_model(record, model):
+    m = model()
+    for key, value in record.items():
+        setattr(m, key, value)
+    return m
+
 
 def classification_to_models(classification, model):
-    models = []
-    for index, row in classification.table.iterrows():
-        row = row.replace([np.nan], [None])
-        m = model()
-        m.id = index.item()
-        m.code = row["code"]
-        m.name_en = row["name"]
-        if "name_es" in row:
-            m.name_es = row["name_es"]
-        if "name_short_en" in row:
-            m.name_short_en = row["name_short_en"]
-        if "name_short_es" in row:
-            m.name_short_es = row["name_short_es"]
-        if "description_es" in row:
-            m.description_es = row["description_es"]
-        if "description_en" in row:
-            m.description_en = row["description_en"]
-        m.level = row["level"]
-        m.parent_id = row["parent_id"]
-        models.append(m)
-    return models
+    return [_record_to_model(record, model)
+            for record in classification_to_records(classification)]
+
+
+def iter_classification_models(classification, model, batch_size=1000):
+    """Like classification_to_models(), but streams out lists of batch_size
+    models at a time."""
+    for batch in classification_to_records(classification, batch_size):
+        yield [_record_to_model(record, model) for record in batch]
 
 
 def fillin(df, entities):
     """STATA style 'fillin', makes sure all combinations of entities in the
-    index are in the dataset."""
-    df = df.set_index(entities)
-    return df.reindex(
-        pd.MultiIndex.from_product(df.index.levels, names=df.index.names))
+    index are in the dataset. This builds the whole dense frame, see
+    fillin_sparse() for datasets where that doesn't fit in memory."""
+    return fillin_sparse(df, entities).to_dense()
+
+
+def fillin_chunks(df, entities):
+    """Like fillin(), but yields the dense frame one value of the first
+    entity at a time."""
+    return fillin_sparse(df, entities).chunks()
+
+
+def fill_ratio(df, entities):
+    """Fraction of all combinations of entities that are in the dataset,
+    without building the dense frame."""
+    return fillin_sparse(df, entities).fill_ratio
+
+
+class SparseFill(object):
+    """The result of a fillin, kept as the rows that are present and their
+    positions in the full product of the entity levels.
+
+    levels are the sorted unique values of each entity, like the levels of
+    the dense frame's MultiIndex, and positions are the flat (row major)
+    indexes of the present rows into their product."""
+
+    def __init__(self, names, levels, positions, values):
+        self.names = names
+        self.levels = levels
+        self.positions = positions
+        self.values = values
+
+    @property
+    def shape(self):
+        return tuple(len(level) for level in self.levels)
+
+    @property
+    def size(self):
+        return int(np.prod([float(n) for n in self.shape]))
+
+    @property
+    def fill_ratio(self):
+        return len(self.positions) / self.size if self.size else 0.0
+
+    def _dense_block(self, start, stop, levels):
+        """Dense frame for the flat positions start to stop, which have to
+        cover whole values of the leading levels."""
+        lo, hi = np.searchsorted(self.positions, [start, stop])
+
+        indexer = np.full(stop - start, -1, dtype=np.int64)
+        indexer[self.positions[lo:hi] - start] = np.arange(lo, hi)
+        found = indexer >= 0
+
+        index = pd.MultiIndex.from_product(levels, names=self.names)
+        block = self.values.iloc[np.where(found, indexer, 0)]
+        block.index = index
+        if not found.all():
+            block = block.where(np.broadcast_to(found[:, None], block.shape))
+        return block
+
+    def to_dense(self):
+        return self._dense_block(0, self.size, self.levels)
+
+    def chunks(self):
+        """Dense frames for each value of the first entity, in order."""
+        chunk_size = self.size // max(self.shape[0], 1)
+        for i, value in enumerate(self.levels[0]):
+            yield self._dense_block(i * chunk_size, (i + 1) * chunk_size,
+                                    [[value]] + self.levels[1:])
+
+
+def fillin_sparse(df, entities):
+    """Rectangularize df on entities without materializing the product of
+    their values: each entity is factorized to sorted integer codes and
+    every row gets its position in the product from those."""
+    names = list(entities)
+    levels = []
+    positions = np.zeros(len(df), dtype=np.int64)
+    present = np.ones(len(df), dtype=bool)
+
+    size = 1.0
+    for entity in names:
+        codes, uniques = pd.factorize(df[entity], sort=True)
+        size *= max(len(uniques), 1)
+        if size >= 2 ** 62:
+            raise ValueError("Too many combinations of {} to rectangularize."
+                             .format(names))
+        positions = positions * len(uniques) + codes
+        # Rows with missing entities aren't part of any combination
+        present &= codes >= 0
+        levels.append(list(uniques))
+
+    values = df.drop(names, axis=1)
+    positions = positions[present]
+    if not present.all():
+        values = values[present]
+
+    order = np.argsort(positions, kind="mergesort")
+    positions = positions[order]
+    if (np.diff(positions) == 0).any():
+        raise ValueError("Can't rectangularize, there are duplicate rows for {}"
+                         .format(names))
+
+    return SparseFill(names, levels, positions, values.iloc[order])
 
 
 def cut_columns(df, columns):
     return df[list(columns)]
 
 
+def match_codes(series, lookup):
+    """Look up classification ids for a column of codes in one vectorized
+    pass: the column is factorized, each unique code is looked up once and
+    the results are mapped back to rows with the integer codes.
+
+    Returns the id for each row, a mask of rows that matched, the unique
+    codes and a mask of which unique codes matched."""
+    code_index, ids = lookup
+    codes, uniques = factorize_codes(series)
+
+    positions = code_index.get_indexer(uniques)
+    uniques_matched = positions >= 0
+
+    # Missing values are coded as -1, which never matches
+    matched = codes >= 0
+    matched[matched] = uniques_matched[codes[matched]]
+
+    row_ids = np.zeros(len(codes), dtype=ids.dtype)
+    row_ids[matched] = ids[positions[codes[matched]]]
+
+    return row_ids, matched, uniques, uniques_matched
+
+
 # Classification.merge_to_table
 # Classification.merge_index
 def merge_to_table(classification, classification_name, df, merge_on):
-    """Merge a classification to a table, given the code field."""
-    code_to_id = classification.reset_index()[["code", "index"]]
-    code_to_id.columns = ["code", classification_name]
-    code_to_id = code_to_id.set_index("code")
-    return df.merge(code_to_id, left_on=merge_on,
-                    right_index=True, how="left")
+    """Merge a classification to a table, given the code field. Rows with
+    codes that aren't in the classification get a missing id."""
+    row_ids, matched, _, _ = match_codes(df[merge_on],
+                                         classification_lookup(classification))
+    df = df.copy()
+    df[classification_name] = pd.Series(row_ids, index=df.index).where(matched)
+    return df
 
 
 def merge_classification_by_id(df, classification, column, prefix="name", name_columns=["name"]):
@@ -64,6 +239,71 @@ def merge_classification_by_id(df, classification, column, prefix="name", name_c
         right_index=True,
     )
 
+def ancestor_ids(classification, from_level, to_level):
+    """Map ids of one level of a classification to the ids of their
+    ancestors at a coarser level, by following parent_id. Returns a Series
+    of ancestor ids indexed by the from_level ids."""
+    table = classification.table
+    ids = table.index[table.level == from_level]
+
+    # Floats so that missing parents can be NaN
+    current = ids.values.astype(np.float64)
+    for _ in range(len(table)):
+        # One step up the hierarchy for every id not there yet
+        levels = table.level.reindex(current).values
+        todo = (levels != to_level) & ~np.isnan(current)
+        if not todo.any():
+            break
+        current[todo] = table.parent_id.reindex(current[todo]).values
+
+    reached = table.level.reindex(current).values == to_level
+    return pd.Series(current[reached].astype(table.index.dtype),
+                     index=ids[reached])
+
+
+def rollup_hierarchy(facet, field, mapping, target_fields, columns):
+    """Sum the additive columns of an aggregated facet up a classification
+    hierarchy: each id in field is replaced with its ancestor from mapping
+    (see ancestor_ids) and the result is grouped by target_fields, which
+    can leave field out altogether."""
+    df = facet[columns].reset_index()
+    dtype = df[field].dtype
+
+    positions = mapping.index.get_indexer(df[field].values)
+    found = positions >= 0
+    if not found.all():
+        warn("Dropping {} rows with no ancestor for field {}."
+             .format((~found).sum(), field))
+        df = df[found]
+        positions = positions[found]
+
+    df[field] = mapping.values[positions].astype(dtype)
+    return df.groupby(list(target_fields))[columns].sum()
+
+
+def compare_rollup(name, derived, expected, rtol=1e-6):
+    """Check a rolled up facet against one aggregated from its own source
+    file. Prints and returns the number of mismatching rows."""
+    joined = derived.join(expected, how="outer", lsuffix="_derived",
+                          rsuffix="_expected")
+
+    mismatches = pd.Series(False, index=joined.index)
+    for column in derived.columns:
+        a = joined[column + "_derived"].values.astype(np.float64)
+        b = joined[column + "_expected"].values.astype(np.float64)
+        close = np.isclose(a, b, rtol=rtol, atol=0) | (np.isnan(a) & np.isnan(b))
+        mismatches |= ~close
+
+    count = int(mismatches.sum())
+    if count:
+        bad("Rollup {} differs from its source file in {} of {} rows:"
+            .format(name, count, len(joined)))
+        bad(joined[mismatches.values].head(10))
+    else:
+        good("Rollup {} matches its source file.".format(name))
+    return count
+
+
 def good(msg):
     return puts("[^_^] " + colored.green(msg))
 
@@ -78,97 +318,598 @@ def bad(msg):
 indented = lambda: indent(4, quote=colored.cyan("> "))
 
 
-def process_dataset(dataset):
+def read_dataset(dataset):
+    """Read the raw dataset, either through its own read_function or from its
+    source_file via the local parsed input cache."""
+    if "read_function" in dataset:
+        return dataset["read_function"]()
+    return input_cache.read_stata_cached(dataset["source_file"])
 
-    puts("=" * 80)
-    good("Processing a new dataset!")
 
-    # Read dataset and fix up columns
-    df = dataset["read_function"]()
-    df = translate_columns(df, dataset["field_mapping"])
-    df = cut_columns(df, dataset["field_mapping"].values())
+def first(x):
+    """Return first element of a group in a pandas GroupBy object"""
+    return x.nth(0)
 
-    if "hook_pre_merge" in dataset:
-        df = dataset["hook_pre_merge"](df)
 
-    puts("Dataset overview:")
-    with indented():
-        infostr = StringIO()
-        df.info(buf=infostr, memory_usage=True, null_counts=True)
-        puts(infostr.getvalue())
+def sum_group(x):
+    """Get the sum for a pandas group by"""
+    return x.sum()
 
-    for field in dataset["facet_fields"]:
-        try:
-            assertions.assert_none_missing(df[field])
-        except AssertionError:
-            warn("Field '{}' has {} missing values."
-                 .format(field, df[field].isnull().sum()))
-
-    # Zero-pad digits of n-digit codes
-    for field, length in dataset["digit_padding"].items():
-        try:
-            assertions.assert_is_zeropadded_string(df[field])
-        except AssertionError:
-            warn("Field '{}' is not padded to {} digits."
-                 .format(field, length))
-            df[field] = df[field].astype(int).astype(str).str.zfill(length)
 
-    # Make sure the dataset is rectangularized by the facet fields
-    try:
-        assertions.assert_rectangularized(df, dataset["facet_fields"])
-    except AssertionError:
-        warn("Dataset is not rectangularized on fields {}"
-             .format(dataset["facet_fields"]))
+def combine_first(partials):
+    """Combine per-chunk results of first(), in chunk order."""
+    combined = pd.concat(partials)
+    return combined[~combined.index.duplicated(keep="first")]
+
+
+def combine_sum(partials):
+    """Combine per-chunk results of sum_group()."""
+    combined = pd.concat(partials)
+    return combined.groupby(level=list(range(combined.index.nlevels))).sum()
+
+
+# How to merge the partial aggregates of each chunk in streaming mode. Only
+# aggregations listed here can be used with a dataset "chunksize".
+CHUNK_COMBINERS = {
+    first: combine_first,
+    sum_group: combine_sum,
+}
+
+# Collapse the list of partial aggregates every this many chunks
+COMBINE_EVERY = 8
+
+# Threads to compute the facets of a dataset on, unless the dataset sets
+# "facet_threads". Datasets already run in parallel processes, so this only
+# pays off for the big ones.
+FACET_THREADS = int(os.environ.get("PERU_INGESTION_FACET_THREADS", 1))
 
-    try:
-        assertions.assert_entities_not_duplicated(df, dataset["facet_fields"])
-    except AssertionError:
-        bad("Dataset has duplicate rows for entity combination: {}"
-            .format(dataset["facet_fields"]))
-        bad(df[df.duplicated(subset=dataset["facet_fields"])])
 
+def prepare_columns(dataset, df):
+    """Rename and cut down to the mapped fields, then run the pre merge hook."""
+    with stage("translate_columns", rows_in=len(df)) as s:
+        df = translate_columns(df, dataset["field_mapping"])
+        df = cut_columns(df, dataset["field_mapping"].values())
+        s["rows_out"] = len(df)
 
-    # Merge in IDs for entity codes
+    if "hook_pre_merge" in dataset:
+        with stage("hook_pre_merge", rows_in=len(df)) as s:
+            df = dataset["hook_pre_merge"](df)
+            s["rows_out"] = len(df)
+
+    return df
+
+
+def pad_digits(df, digit_padding, warned=None):
+    """Zero-pad digits of n-digit codes. If a set is passed as warned, only
+    warn about each field once (e.g. across chunks)."""
+    for field, length in digit_padding.items():
+        with stage("padding:" + field, rows_in=len(df)) as s:
+            if validation.zeropadding_violations(df[field]) > 0:
+                if warned is None or field not in warned:
+                    warn("Field '{}' is not padded to {} digits."
+                         .format(field, length))
+                    if warned is not None:
+                        warned.add(field)
+                df[field] = df[field].astype(int).astype(str).str.zfill(length)
+            s["rows_out"] = len(df)
+    return df
+
+
+# Dtypes that columns are compacted to, unless the dataset's "dtypes" says
+# otherwise (see compaction.py). The code columns of the classification
+# fields also become categoricals. Ids get a fixed width rather than the
+# smallest that fits each frame (or chunk), so the same column has the same
+# dtype in every table and every build. They're kept signed: unsigned facet
+# fields end up as uint64 indexes, which PyTables can't index.
+DEFAULT_DTYPES = OrderedDict([
+    ("year", "int16"),
+    ("*_id", "int32"),
+])
+
+
+def dataset_dtypes(dataset):
+    dtypes = OrderedDict(
+        (field, "category") for field in dataset["classification_fields"])
+    dtypes.update(DEFAULT_DTYPES)
+    dtypes.update(dataset.get("dtypes", {}))
+    return dtypes
+
+
+def compact_dtypes(dataset, df, warned=None):
+    """Shrink column dtypes as configured by dataset_dtypes(). If a set is
+    passed as warned, only warn about each column once (e.g. across
+    chunks)."""
+    with stage("compact_dtypes", rows_in=len(df)) as s:
+        bytes_before = df.memory_usage(deep=True).sum()
+        df, skipped = compaction.compact(
+            df, dataset_dtypes(dataset),
+            dataset.get("float_tolerance", compaction.DEFAULT_FLOAT_TOLERANCE))
+        bytes_after = df.memory_usage(deep=True).sum()
+        s["rows_out"] = len(df)
+
+    for column, dtype in skipped:
+        if warned is None or column not in warned:
+            warn("Can't compact column '{}' to {} without losing information."
+                 .format(column, dtype))
+            if warned is not None:
+                warned.add(column)
+
+    if warned is None:
+        puts("Compacted columns from {:.1f}MB to {:.1f}MB.".format(
+            bytes_before / 1e6, bytes_after / 1e6))
+    return df
+
+
+def merge_classification_fields(dataset, df):
+    """Merge in IDs for entity codes, dropping rows with unknown codes."""
     for field_name, c in dataset["classification_fields"].items():
-        classification_table = c["classification"].level(c["level"])
+        with stage("merge:" + field_name, rows_in=len(df)) as s:
+            df = _merge_classification_field(df, field_name, c)
+            s["rows_out"] = len(df)
+    return df
 
-        (p_nonmatch_rows, p_nonmatch_unique,
-         codes_missing, codes_unused) = assertions.matching_stats(df[field_name], classification_table)
 
-        if p_nonmatch_rows > 0:
-            bad("Errors when Merging field {}:".format(field_name))
-            with indented():
-                puts("Percentage of nonmatching rows: {}".format(p_nonmatch_rows))
-                puts("Percentage of nonmatching codes: {}".format(p_nonmatch_unique))
-                puts("Codes missing in classification:\n{}".format(codes_missing.reset_index(drop=True)))
-                puts("Codes unused:\n{}".format(codes_unused.reset_index(drop=True)))
+def _merge_classification_field(df, field_name, c):
+    lookup = level_index(c["classification"], c["level"]).lookup
+
+    row_ids, matched, uniques, uniques_matched = match_codes(
+        df[field_name], lookup)
+
+    if not matched.all():
+        bad("Dropping {} rows with codes not in the classification for field {}."
+            .format((~matched).sum(), field_name))
+        df = df[matched].copy()
+        row_ids = row_ids[matched]
 
-            bad("Dropping nonmatching rows.")
-            df = df[~df[field_name].isin(codes_missing)]
+    df[field_name + "_id"] = row_ids
+    return df
 
-        df = merge_to_table(classification_table,
-                            field_name + "_id",
-                            df, field_name)
 
-    # Gather each facet dataset (e.g. DY, PY, DPY variables from DPY dataset)
+def merge_classification_fields_chunk(dataset, df, nonmatch_stats):
+    """Chunked version of merge_classification_fields. Instead of reporting
+    per chunk, nonmatching rows and codes are tallied into nonmatch_stats."""
+    for field_name, c in dataset["classification_fields"].items():
+        with stage("merge:" + field_name, rows_in=len(df)) as s:
+            df = _merge_classification_field_chunk(df, field_name, c,
+                                                   nonmatch_stats)
+            s["rows_out"] = len(df)
+    return df
+
+
+def _merge_classification_field_chunk(df, field_name, c, nonmatch_stats):
+    lookup = level_index(c["classification"], c["level"]).lookup
+
+    row_ids, matched, uniques, uniques_matched = match_codes(
+        df[field_name], lookup)
+
+    stats = nonmatch_stats.setdefault(
+        field_name, {"rows": 0, "nonmatching_rows": 0, "codes_missing": set()})
+    stats["rows"] += len(df)
+
+    if not matched.all():
+        stats["nonmatching_rows"] += (~matched).sum()
+        stats["codes_missing"].update(uniques[~uniques_matched])
+        df = df[matched].copy()
+        row_ids = row_ids[matched]
+
+    df[field_name + "_id"] = row_ids
+    return df
+
+
+def group_aggregations(aggregations):
+    """Invert {agg_field: agg_func} into {agg_func: [agg_fields]}, keeping
+    the field order."""
+    by_func = OrderedDict()
+    for agg_field, agg_func in aggregations.items():
+        by_func.setdefault(agg_func, []).append(agg_field)
+    return by_func
+
+
+def rollup_source(facet_fields, agg_field, facet_outputs, facets, num_rows):
+    """Find the smallest already computed facet that is finer than
+    facet_fields and that sums for agg_field can be rolled up from. That is
+    one that either sums agg_field too, or takes its first() over groups that
+    are single rows (so that first is the same thing as sum)."""
+    best = None
+    for source_fields, source in facet_outputs.items():
+        if not set(facet_fields) < set(source_fields):
+            continue
+
+        source_func = facets[source_fields].get(agg_field)
+        if source_func is sum_group or \
+                (source_func is first and len(source) == num_rows):
+            if best is None or len(source) < len(facet_outputs[best]):
+                best = source_fields
+    return best
+
+
+def facet_map(dataset, function, items):
+    """[function(item) for item in items], on dataset["facet_threads"]
+    threads if more than one. Results are in the order of items either
+    way. Functions run like this shouldn't print, clint's indentation isn't
+    thread safe."""
+    threads = dataset.get("facet_threads", FACET_THREADS)
+    if threads <= 1 or len(items) <= 1:
+        return [function(item) for item in items]
+    with concurrent.futures.ThreadPoolExecutor(threads) as executor:
+        return list(executor.map(function, items))
+
+
+def plan_facet(facet_fields, facets, facet_outputs, num_rows):
+    """Split the aggregations of a facet into ones done on the dataset and
+    sums that can be rolled up from already computed facets. Returns
+    ({agg_field: agg_func}, {source facet: [agg_fields]})."""
+    raw_aggregations = OrderedDict()
+    rollups = OrderedDict()
+    for agg_field, agg_func in facets[facet_fields].items():
+        source_fields = None
+        if agg_func is sum_group:
+            source_fields = rollup_source(facet_fields, agg_field,
+                                          facet_outputs, facets, num_rows)
+        if source_fields is None:
+            raw_aggregations[agg_field] = agg_func
+        else:
+            rollups.setdefault(source_fields, []).append(agg_field)
+    return raw_aggregations, rollups
+
+
+def compute_facet(df, facet_fields, aggregations, raw_aggregations, rollups,
+                  facet_outputs):
+    agg_outputs = []
+    for source_fields, agg_fields in rollups.items():
+        source = facet_outputs[source_fields][agg_fields]
+        with stage("rollup:{}:{}".format(facet_fields, agg_fields),
+                   rows_in=len(source)) as s:
+            agg_outputs.append(
+                source.groupby(level=list(facet_fields)).sum())
+            s["rows_out"] = len(agg_outputs[-1])
+
+    if raw_aggregations:
+        facet_groupby = df.groupby(list(facet_fields))
+        for agg_func, agg_fields in group_aggregations(raw_aggregations).items():
+            with stage("aggregate:{}:{}".format(facet_fields, agg_fields),
+                       rows_in=len(df)) as s:
+                agg_outputs.append(agg_func(facet_groupby[agg_fields]))
+                s["rows_out"] = len(agg_outputs[-1])
+
+    facet = pd.concat(agg_outputs, axis=1)
+    return facet[list(aggregations.keys())]
+
+
+def aggregate_facets(dataset, df):
+    """Gather each facet dataset (e.g. DY, PY, DPY variables from DPY
+    dataset). Facets are done finest first, so that sums for coarser facets
+    can be rolled up from already aggregated finer ones instead of grouping
+    the whole dataset again.
+
+    Facets with the same number of fields can't be rolled up from each
+    other, so each such group of them can run at once, see facet_map()."""
+    facets = dataset["facets"]
     facet_outputs = {}
-    for facet_fields, aggregations in dataset["facets"].items():
-        puts("Working on facet: {}".format(facet_fields))
-        facet_groupby = df.groupby(facet_fields)
 
-        # Do specified aggregations / groupings for each column
-        # like mean, first, min, rank, etc
+    for size in sorted(set(len(f) for f in facets), reverse=True):
+        wave = [f for f in facets if len(f) == size]
+
+        plans = []
+        for facet_fields in wave:
+            raw_aggregations, rollups = plan_facet(facet_fields, facets,
+                                                   facet_outputs, len(df))
+            plans.append((facet_fields, raw_aggregations, rollups))
+
+            puts("Working on facet: {}".format(facet_fields))
+            with indented():
+                for source_fields, agg_fields in rollups.items():
+                    puts("Rolling up {} from facet {}".format(agg_fields, source_fields))
+                if raw_aggregations:
+                    puts("Aggregating: {}".format(list(raw_aggregations.keys())))
+
+        def compute(plan):
+            facet_fields, raw_aggregations, rollups = plan
+            return compute_facet(df, facet_fields, facets[facet_fields],
+                                 raw_aggregations, rollups, facet_outputs)
+
+        for (facet_fields, _, _), facet in zip(plans, facet_map(dataset, compute, plans)):
+            facet_outputs[facet_fields] = facet
+
+    return {facet_fields: facet_outputs[facet_fields]
+            for facet_fields in facets}
+
+
+def stream_stats(dataset):
+    """What stream_chunks() tallies up while reading."""
+    return {
+        "rows": 0,
+        "merged_rows": 0,
+        "missing": {field: 0 for field in dataset["facet_fields"]},
+        "nonmatch": {},
+    }
+
+
+def stream_chunks(dataset, stats):
+    """Read the source file dataset["chunksize"] rows at a time and yield
+    each chunk cleaned and merged. Missing values, nonmatching codes and
+    row counts are tallied into stats as it goes."""
+    padding_warned = set()
+    compaction_warned = set()
+
+    with pd.read_stata(dataset["source_file"], iterator=True,
+                       chunksize=dataset["chunksize"]) as reader:
+        chunks = iter(reader)
+        while True:
+            with stage("read_chunk") as s:
+                chunk = next(chunks, None)
+                s["rows_out"] = 0 if chunk is None else len(chunk)
+            if chunk is None:
+                break
+
+            chunk = prepare_columns(dataset, chunk)
+            stats["rows"] += len(chunk)
+
+            for field in dataset["facet_fields"]:
+                stats["missing"][field] += chunk[field].isnull().sum()
+
+            chunk = pad_digits(chunk, dataset["digit_padding"], padding_warned)
+            chunk = compact_dtypes(dataset, chunk, compaction_warned)
+            chunk = merge_classification_fields_chunk(dataset, chunk,
+                                                      stats["nonmatch"])
+            chunk = compact_dtypes(dataset, chunk, compaction_warned)
+            stats["merged_rows"] += len(chunk)
+
+            yield chunk
+
+
+def aggregate_chunks(dataset, chunks, facets):
+    """Aggregate each facet ({facet_fields: {agg_field: agg_func}}) over
+    chunks, combining the partial aggregates with CHUNK_COMBINERS."""
+    partials = {}
+    facet_list = list(facets)
+
+    for chunk in chunks:
+        def aggregate_chunk(facet_fields):
+            facet_groupby = chunk.groupby(list(facet_fields))
+            chunk_partials = []
+            for agg_func, agg_fields in group_aggregations(
+                    facets[facet_fields]).items():
+                with stage("aggregate_chunk:{}:{}".format(facet_fields, agg_fields),
+                           rows_in=len(chunk)) as s:
+                    chunk_partials.append(
+                        (agg_func, agg_func(facet_groupby[agg_fields])))
+                    s["rows_out"] = len(chunk_partials[-1][1])
+            return chunk_partials
+
+        chunk_results = facet_map(dataset, aggregate_chunk, facet_list)
+        for facet_fields, chunk_partials in zip(facet_list, chunk_results):
+            for agg_func, partial in chunk_partials:
+                facet_partials = partials.setdefault((facet_fields, agg_func), [])
+                facet_partials.append(partial)
+                if len(facet_partials) >= COMBINE_EVERY:
+                    facet_partials[:] = [CHUNK_COMBINERS[agg_func](facet_partials)]
+
+        del chunk, chunk_results
+
+    facet_outputs = {}
+    for facet_fields, aggregations in facets.items():
+        puts("Combining facet: {}".format(facet_fields))
         agg_outputs = []
+        for agg_func, agg_fields in group_aggregations(aggregations).items():
+            facet_partials = partials.pop((facet_fields, agg_func))
+            with stage("combine:{}:{}".format(facet_fields, agg_fields),
+                       rows_in=sum(len(p) for p in facet_partials)) as s:
+                agg_outputs.append(CHUNK_COMBINERS[agg_func](facet_partials))
+                s["rows_out"] = len(agg_outputs[-1])
+        facet = pd.concat(agg_outputs, axis=1).sort_index()
+        facet_outputs[facet_fields] = facet[list(aggregations.keys())]
+    return facet_outputs
+
+
+def plan_chunked_facets(facets):
+    """Split the facets of a streamed dataset into aggregations done on each
+    chunk and sums deferred until the finer facets they can be rolled up
+    from are combined. Only aggregations of finer facets that aren't
+    deferred themselves count as sources."""
+    per_chunk = OrderedDict()
+    deferred = OrderedDict()
+    for facet_fields in sorted(facets, key=len, reverse=True):
+        for agg_field, agg_func in facets[facet_fields].items():
+            can_roll_up = agg_func is sum_group and any(
+                set(facet_fields) < set(source_fields) and
+                per_chunk.get(source_fields, {}).get(agg_field) in (sum_group, first)
+                for source_fields in per_chunk)
+            target = deferred if can_roll_up else per_chunk
+            target.setdefault(facet_fields, OrderedDict())[agg_field] = agg_func
+    return per_chunk, deferred
+
+
+def process_dataset_chunked(dataset):
+    """Streaming version of process_dataset for datasets too big to hold in
+    memory a few times over. The source file is read dataset["chunksize"]
+    rows at a time, each chunk is cleaned, merged and aggregated on its own
+    and the partial aggregates are combined with CHUNK_COMBINERS. Like in
+    aggregate_facets(), sums that can be rolled up from a finer facet aren't
+    aggregated per chunk but from the combined finer facet. If that turns
+    out not to be possible (first() over groups that aren't single rows),
+    the file is read a second time for them.
+
+    The file is parsed straight from the source, not through the input
+    cache, which only holds whole frames. Checks that need the whole dataset
+    at once (rectangularization, duplicate entities, unused classification
+    codes) are skipped; missing values, padding and nonmatching codes are
+    still reported. The dataset's "validation" level doesn't apply."""
+
+    if "source_file" not in dataset:
+        raise ValueError("Streaming mode needs a dataset with a source_file.")
+
+    facets = dataset["facets"]
+    for aggregations in facets.values():
         for agg_field, agg_func in aggregations.items():
-            with indented():
-                puts("Working on: {}".format(agg_field))
+            if agg_func not in CHUNK_COMBINERS:
+                raise ValueError(
+                    "Aggregation for '{}' can't be combined across chunks."
+                    .format(agg_field))
+
+    warn("Streaming in chunks of {} rows, without the input cache and "
+         "skipping the rectangularization, duplicate and unused code "
+         "checks.".format(dataset["chunksize"]))
+    if "validation" in dataset:
+        warn("Ignoring validation level '{}' while streaming."
+             .format(dataset["validation"]))
+
+    stats = stream_stats(dataset)
+
+    per_chunk, deferred = plan_chunked_facets(facets)
+    facet_outputs = aggregate_chunks(dataset, stream_chunks(dataset, stats),
+                                     per_chunk)
+
+    puts("Read {} rows.".format(stats["rows"]))
 
-            agged_row = agg_func(facet_groupby[[agg_field]])
-            agg_outputs.append(agged_row)
+    for field, count in stats["missing"].items():
+        if count > 0:
+            warn("Field '{}' has {} missing values.".format(field, count))
 
-        facet = pd.concat(agg_outputs, axis=1)
+    for field_name, nonmatch in stats["nonmatch"].items():
+        if nonmatch["nonmatching_rows"] > 0:
+            bad("Errors when Merging field {}:".format(field_name))
+            with indented():
+                puts("Percentage of nonmatching rows: {}".format(
+                    100.0 * nonmatch["nonmatching_rows"] / nonmatch["rows"]))
+                puts("Codes missing in classification:\n{}".format(
+                    sorted(nonmatch["codes_missing"])))
+            bad("Dropped nonmatching rows.")
+
+    # Roll up the deferred sums, finest first so that they can be rolled up
+    # from each other too
+    second_pass = OrderedDict()
+    for facet_fields, aggregations in deferred.items():
+        computed = {
+            source_fields: {agg_field: facets[source_fields][agg_field]
+                            for agg_field in facet.columns}
+            for source_fields, facet in facet_outputs.items()
+        }
+        rollups = OrderedDict()
+        for agg_field, agg_func in aggregations.items():
+            source_fields = rollup_source(facet_fields, agg_field, facet_outputs,
+                                          computed, stats["merged_rows"])
+            if source_fields is None:
+                second_pass.setdefault(facet_fields, OrderedDict())[agg_field] = agg_func
+            else:
+                rollups.setdefault(source_fields, []).append(agg_field)
+        if not rollups:
+            continue
+
+        puts("Working on facet: {}".format(facet_fields))
+        with indented():
+            for source_fields, agg_fields in rollups.items():
+                puts("Rolling up {} from facet {}".format(agg_fields, source_fields))
+
+        rolled_up = OrderedDict((agg_field, aggregations[agg_field])
+                                for agg_fields in rollups.values()
+                                for agg_field in agg_fields)
+        facet = compute_facet(None, facet_fields, rolled_up, {}, rollups,
+                              facet_outputs)
+        if facet_fields in facet_outputs:
+            facet = pd.concat([facet_outputs[facet_fields], facet], axis=1)
         facet_outputs[facet_fields] = facet
 
+    if second_pass:
+        warn("Can't roll up the sums of facets {} from finer ones, reading the "
+             "file again for them.".format(list(second_pass)))
+        stats = stream_stats(dataset)
+        for facet_fields, facet in aggregate_chunks(
+                dataset, stream_chunks(dataset, stats), second_pass).items():
+            if facet_fields in facet_outputs:
+                facet = pd.concat([facet_outputs[facet_fields], facet], axis=1)
+            facet_outputs[facet_fields] = facet
+
+    return {facet_fields: facet_outputs[facet_fields]
+            [list(aggregations.keys())].sort_index()
+            for facet_fields, aggregations in facets.items()}
+
+
+def validate_dataset(dataset, df):
+    """Check missing values, padding, duplicates, rectangularization and
+    classification coverage of the facet fields in one pass. The level
+    (full / sampled / off) can be set per dataset with "validation". Streamed
+    datasets (see process_dataset_chunked) aren't validated like this."""
+    lookups = {
+        field_name: level_index(c["classification"], c["level"]).lookup
+        for field_name, c in dataset["classification_fields"].items()
+    }
+    return validation.validate(df, dataset["facet_fields"],
+                               digit_padding=dataset["digit_padding"],
+                               classification_lookups=lookups,
+                               level=dataset.get("validation"))
+
+
+def log_validation_report(dataset, report):
+    if report.level == "off":
+        warn("Skipped validation.")
+        return
+    if report.level == "sampled":
+        warn("Validated a sample of {} out of {} rows."
+             .format(report.checked_rows, report.rows))
+
+    for field, count in report.null_counts.items():
+        if count > 0:
+            warn("Field '{}' has {} missing values.".format(field, count))
+
+    for field, count in report.padding_violations.items():
+        if count > 0:
+            warn("Field '{}' has {} values that are not zero padded."
+                 .format(field, count))
+
+    # Make sure the dataset is rectangularized by the facet fields
+    if report.rectangular is False:
+        warn("Dataset is not rectangularized on fields {} ({:.1%} filled)"
+             .format(dataset["facet_fields"], report.fill_ratio))
+
+    if report.duplicate_rows > 0:
+        bad("Dataset has {} duplicate rows for entity combination: {}"
+            .format(report.duplicate_rows, dataset["facet_fields"]))
+        bad(report.duplicate_examples)
+
+    for field_name, coverage in report.coverage.items():
+        if coverage["nonmatching_rows"] > 0:
+            bad("Errors when Merging field {}:".format(field_name))
+            with indented():
+                puts("Percentage of nonmatching rows: {}".format(coverage["p_nonmatch_rows"]))
+                puts("Percentage of nonmatching codes: {}".format(coverage["p_nonmatch_unique"]))
+                puts("Codes missing in classification:\n{}".format(coverage["codes_missing"]))
+                puts("Codes unused:\n{}".format(coverage["codes_unused"]))
+
+
+def process_dataset(dataset):
+
+    puts("=" * 80)
+    good("Processing a new dataset!")
+
+    if dataset.get("chunksize"):
+        facet_outputs = process_dataset_chunked(dataset)
+        puts("Done! ヽ(◔◡◔)ﾉ")
+        return facet_outputs
+
+    # Read dataset and fix up columns
+    with stage("read") as s:
+        df = read_dataset(dataset)
+        s["rows_out"] = len(df)
+    df = prepare_columns(dataset, df)
+
+    puts("Dataset overview:")
+    with indented():
+        infostr = StringIO()
+        df.info(buf=infostr, memory_usage=True, null_counts=True)
+        puts(infostr.getvalue())
+
+    df = pad_digits(df, dataset["digit_padding"])
+    df = compact_dtypes(dataset, df)
+
+    with stage("validate", rows_in=len(df)):
+        report = validate_dataset(dataset, df)
+    log_validation_report(dataset, report)
+
+    df = merge_classification_fields(dataset, df)
+    df = compact_dtypes(dataset, df)
+    facet_outputs = aggregate_facets(dataset, df)
+
     puts("Done! ヽ(◔◡◔)ﾉ")
 
     return facet_outputs
@@ -1,24 +1,30 @@
-import pandas as pd
 import os.path
 
-from linnaeus import classification
+import classification_cache
+from dataset_tools import first, sum_group, ancestor_ids, rollup_hierarchy, \
+    compare_rollup
 
-product_classification = classification.load("product/HS/Peru_Datlas/out/products_peru_datlas.csv")
-location_classification = classification.load("location/Peru/datlas/out/locations_peru_datlas.csv")
-country_classification = classification.load("location/International/ISO-CID/out/locations_international_iso_cid.csv")
+product_classification = classification_cache.load("product/HS/Peru_Datlas/out/products_peru_datlas.csv")
+location_classification = classification_cache.load("location/Peru/datlas/out/locations_peru_datlas.csv")
+country_classification = classification_cache.load("location/International/ISO-CID/out/locations_international_iso_cid.csv")
 
 
-def first(x):
-    """Return first element of a group in a pandas GroupBy object"""
-    return x.nth(0)
+DATASET_ROOT = "/nfs/home/M/makmanalp/shared_space/cidgrowlab/Atlas/Peru/results/"
 
+# With --stream, the rcpy datasets are read in chunks of this many rows to
+# bound memory. Streaming skips the input cache and the whole dataset checks
+# (see dataset_tools.process_dataset_chunked), so it's off by default.
+RCPY_CHUNKSIZE = 2000000
 
-def sum_group(x):
-    """Get the sum for a pandas group by"""
-    return x.sum()
+# The rcpy tables are by far the biggest in data.h5, so they're compressed.
+# See output.HDF_LAYOUT_KEYS for what else can be set per table.
+RCPY_HDF_LAYOUT = {
+    "complevel": 5,
+}
 
+# Their facets are big groupbys over four keys, computed on this many threads
+RCPY_FACET_THREADS = 3
 
-DATASET_ROOT = "/nfs/home/M/makmanalp/shared_space/cidgrowlab/Atlas/Peru/results/"
 
 def prefix_path(to_prefix):
     return os.path.join(DATASET_ROOT, to_prefix)
@@ -49,7 +55,7 @@ def hook_country(df):
     return df
 
 trade4digit_country = {
-    "read_function": lambda: pd.read_stata(prefix_path("trade_4digit_complexity_country.dta")),
+    "source_file": prefix_path("trade_4digit_complexity_country.dta"),
     "hook_pre_merge": hook_country,
     "field_mapping": {
         "hs4": "product",
@@ -101,7 +107,7 @@ def hook_department(df):
     return df
 
 trade4digit_department = {
-    "read_function": lambda: pd.read_stata(prefix_path("trade_4digit_complexity_dpto.dta")),
+    "source_file": prefix_path("trade_4digit_complexity_dpto.dta"),
     "hook_pre_merge": hook_department,
     "field_mapping": {
         "dpto": "location",
@@ -150,7 +156,7 @@ def hook_province(df):
     return df
 
 trade4digit_province = {
-    "read_function": lambda: pd.read_stata(prefix_path("trade_4digit_complexity_prov.dta")),
+    "source_file": prefix_path("trade_4digit_complexity_prov.dta"),
     "hook_pre_merge": hook_province,
     "field_mapping": {
         "prov": "location",
@@ -198,7 +204,9 @@ def hook_rcpy_country(df):
     return df
 
 trade4digit_rcpy_country = {
-    "read_function": lambda: pd.read_stata(prefix_path("trade_4digit_rcpy_country.dta")),
+    "source_file": prefix_path("trade_4digit_rcpy_country.dta"),
+    "hdf_layout": RCPY_HDF_LAYOUT,
+    "facet_threads": RCPY_FACET_THREADS,
     "hook_pre_merge": hook_rcpy_country,
     "field_mapping": {
         "country": "location",
@@ -245,7 +253,9 @@ def hook_rcpy_department(df):
     return df
 
 trade4digit_rcpy_department = {
-    "read_function": lambda: pd.read_stata(prefix_path("trade_4digit_rcpy_dpto.dta")),
+    "source_file": prefix_path("trade_4digit_rcpy_dpto.dta"),
+    "hdf_layout": RCPY_HDF_LAYOUT,
+    "facet_threads": RCPY_FACET_THREADS,
     "hook_pre_merge": hook_rcpy_department,
     "field_mapping": {
         "dpto": "location",
@@ -289,7 +299,9 @@ def hook_rcpy_province(df):
     return df
 
 trade4digit_rcpy_province = {
-    "read_function": lambda: pd.read_stata(prefix_path("trade_4digit_rcpy_prov.dta")),
+    "source_file": prefix_path("trade_4digit_rcpy_prov.dta"),
+    "hdf_layout": RCPY_HDF_LAYOUT,
+    "facet_threads": RCPY_FACET_THREADS,
     "hook_pre_merge": hook_rcpy_province,
     "field_mapping": {
         "prov": "location",
@@ -335,7 +347,7 @@ def hook_demographics(df):
     return df
 
 demographics = {
-    "read_function": lambda: pd.read_stata('/nfs/projects_nobackup/c/cidgrowlab/Atlas/Peru/rawdata/INEI/gdp_pop_department.dta'),
+    "source_file": "/nfs/projects_nobackup/c/cidgrowlab/Atlas/Peru/rawdata/INEI/gdp_pop_department.dta",
     "hook_pre_merge": hook_demographics,
     "field_mapping": {
         "dpto": "location",
@@ -369,205 +381,293 @@ demographics = {
 
 
 
-if __name__ == "__main__":
-    import dataset_tools
-
-    store = pd.HDFStore("data.h5", complib="blosc")
-
-    # Country Product Year
-    cpy = dataset_tools.process_dataset(trade4digit_country)
-    df = cpy[("location_id", "product_id", "year")].reset_index()
-
-    df.to_hdf(store, "country_product_year", format="table")
-    attrs = {
-        "sql_table_name": "country_product_year",
-        "location_level": "country",
-        "product_level": "4digit"
-    }
-    store.get_storer("/country_product_year").attrs.atlas_metadata = attrs
-
-
-    # Country Year
-    cy = cpy[("location_id", "year")].reset_index()
-
-    cy.to_hdf(store, "country_year", format="table")
-    attrs = {
-        "location_level": "country",
-    }
-    store.get_storer("country_year").attrs.atlas_metadata = attrs
-
-
-    # Product Year
-    py = cpy[("product_id", "year")].reset_index()
-    py.to_hdf(store, "product_year", format="table")
-    attrs = {
-        "sql_table_name": "product_year",
-        "product_level": "4digit",
-    }
-    store.get_storer("product_year").attrs.atlas_metadata = attrs
+DATASETS = {
+    "trade4digit_country": trade4digit_country,
+    "trade4digit_department": trade4digit_department,
+    "trade4digit_province": trade4digit_province,
+    "trade4digit_rcpy_country": trade4digit_rcpy_country,
+    "trade4digit_rcpy_department": trade4digit_rcpy_department,
+    "trade4digit_rcpy_province": trade4digit_rcpy_province,
+    "demographics": demographics,
+}
 
+# The datasets that --stream reads in chunks
+STREAMED_DATASETS = [
+    "trade4digit_rcpy_country",
+    "trade4digit_rcpy_department",
+    "trade4digit_rcpy_province",
+]
 
-    df = dataset_tools.process_dataset(trade4digit_department)
 
-    # Department Product Year
-    dpy = df[("location_id", "product_id", "year")].reset_index()
-    dpy.to_hdf(store, "department_product_year", format="table")
-    attrs = {
-        "sql_table_name": "department_product_year",
-        "location_level": "department",
-        "product_level": "4digit"
-    }
-    store.get_storer("department_product_year").attrs.atlas_metadata = attrs
+def streaming_datasets(datasets, chunksize=RCPY_CHUNKSIZE):
+    """A copy of datasets where the STREAMED_DATASETS are read chunksize
+    rows at a time."""
+    datasets = dict(datasets)
+    for name in STREAMED_DATASETS:
+        datasets[name] = dict(datasets[name], chunksize=chunksize)
+    return datasets
 
-    # Department Year
-    trade_dpy = df[("location_id", "year")]
 
-    demographics = dataset_tools.process_dataset(demographics)
-    demographics = demographics[("location_id", "year")]
+def build_department_year(results):
+    trade_dy = results["trade4digit_department"][("location_id", "year")]
+    demographics_dy = results["demographics"][("location_id", "year")]
 
-    dpy = trade_dpy\
-        .join(demographics, how="outer")\
+    dy = trade_dy\
+        .join(demographics_dy, how="outer")\
         .reset_index()
 
-    dpy = dpy.drop("export_value", axis=1)
-
-    dpy.to_hdf(store, "department_year", format="table")
-    attrs = {
-        "sql_table_name": "department_year",
-        "location_level": "department",
-    }
-    store.get_storer("department_year").attrs.atlas_metadata = attrs
-
-
-    # Province
-    df = dataset_tools.process_dataset(trade4digit_province)
-
-    # Province Product Year
-    ppy = df[("location_id", "product_id", "year")].reset_index()
-
-    ppy.to_hdf(store, "msa_product_year", format="table")
-    attrs = {
-        "sql_table_name": "msa_product_year",
-        "location_level": "msa",
-        "product_level": "4digit"
-    }
-    store.get_storer("msa_product_year").attrs.atlas_metadata = attrs
-
-    # Province Year
-    py = df[("location_id", "year")].reset_index()
-
-    py.to_hdf(store, "msa_year", format="table")
-    attrs = {
-        "sql_table_name": "msa_year",
-        "location_level": "msa",
-    }
-    store.get_storer("msa_year").attrs.atlas_metadata = attrs
-
-
-    # RCPY Country
-    df = dataset_tools.process_dataset(trade4digit_rcpy_country)
-
-    ret = df[("country_id", "location_id", "year")].reset_index()
-    ret.to_hdf(store, "country_country_year", format="table")
-    attrs = {
-        "sql_table_name": "country_country_year",
-        "location_level": "country",
-        "country_level": "country",
-    }
-    store.get_storer("country_country_year").attrs.atlas_metadata = attrs
-
-    ret = df[("product_id", "country_id", "year")].reset_index()
-    ret.to_hdf(store, "partner_product_year", format="table")
-    attrs = {
-        "sql_table_name": "partner_product_year",
-        "country_level": "country",
-        "product_level": "4digit"
-    }
-    store.get_storer("partner_product_year").attrs.atlas_metadata = attrs
-
-    ret = df[("country_id", "location_id", "product_id", "year")].reset_index()
-    ret.to_hdf(store, "country_country_product_year", format="table")
-    attrs = {
-        # Removed because we don't need to ingest this for the API
-        #"sql_table_name": "country_country_product_year",
-        "country_level": "country",
-        "location_level": "country",
-        "product_level": "4digit"
-    }
-    store.get_storer("country_country_product_year").attrs.atlas_metadata = attrs
-
-    # RCPY Department
-    df = dataset_tools.process_dataset(trade4digit_rcpy_department)
-
-    ret = df[("country_id", "location_id", "year")].reset_index()
-    ret.to_hdf(store, "country_department_year", format="table")
-    attrs = {
-        "sql_table_name": "country_department_year",
-        "location_level": "department",
-        "country_level": "country",
-    }
-    store.get_storer("country_department_year").attrs.atlas_metadata = attrs
-
-    ret = df[("country_id", "location_id", "product_id", "year")].reset_index()
-    ret.to_hdf(store, "country_department_product_year", format="table")
-    attrs = {
-        "sql_table_name": "country_department_product_year",
-        "country_level": "country",
-        "location_level": "department",
-        "product_level": "4digit"
-    }
-    store.get_storer("country_department_product_year").attrs.atlas_metadata = attrs
-
-    # RCPY Province
-    df = dataset_tools.process_dataset(trade4digit_rcpy_province)
-
-    ret = df[("country_id", "location_id", "year")].reset_index()
-    ret.to_hdf(store, "country_msa_year", format="table")
-    attrs = {
-        "sql_table_name": "country_msa_year",
-        "location_level": "msa",
-        "country_level": "country",
-    }
-    store.get_storer("country_msa_year").attrs.atlas_metadata = attrs
-
-    ret = df[("country_id", "location_id", "product_id", "year")].reset_index()
-    ret.to_hdf(store, "country_msa_product_year", format="table")
-    attrs = {
-        "sql_table_name": "country_msa_product_year",
-        "country_level": "country",
-        "location_level": "msa",
-        "product_level": "4digit"
-    }
-    store.get_storer("country_msa_product_year").attrs.atlas_metadata = attrs
+    return dy.drop("export_value", axis=1)
 
 
-    # Product Classification
-    df = product_classification.table.reset_index()
+def classification_table(classification):
+    return lambda results: classification.table.reset_index()
 
-    df.to_hdf(store, "/classifications/product", format="table")
-    attrs = {
-        "sql_table_name": "product",
-    }
-    store.get_storer("/classifications/product").attrs.atlas_metadata = attrs
 
+# Each output table in data.h5, along with which dataset results it needs.
+# Plain facet tables just name a dataset and facet, anything else gets a
+# build_function that takes the dict of processed dataset results.
+TABLES = {
+    "country_product_year": {
+        "dataset": "trade4digit_country",
+        "facet": ("location_id", "product_id", "year"),
+        "attrs": {
+            "sql_table_name": "country_product_year",
+            "location_level": "country",
+            "product_level": "4digit"
+        },
+    },
+    "country_year": {
+        "dataset": "trade4digit_country",
+        "facet": ("location_id", "year"),
+        "attrs": {
+            "location_level": "country",
+        },
+    },
+    "product_year": {
+        "dataset": "trade4digit_country",
+        "facet": ("product_id", "year"),
+        "attrs": {
+            "sql_table_name": "product_year",
+            "product_level": "4digit",
+        },
+    },
+    "department_product_year": {
+        "dataset": "trade4digit_department",
+        "facet": ("location_id", "product_id", "year"),
+        "attrs": {
+            "sql_table_name": "department_product_year",
+            "location_level": "department",
+            "product_level": "4digit"
+        },
+    },
+    "department_year": {
+        "requires": ["trade4digit_department", "demographics"],
+        "build_function": build_department_year,
+        "attrs": {
+            "sql_table_name": "department_year",
+            "location_level": "department",
+        },
+    },
+    "msa_product_year": {
+        "dataset": "trade4digit_province",
+        "facet": ("location_id", "product_id", "year"),
+        "attrs": {
+            "sql_table_name": "msa_product_year",
+            "location_level": "msa",
+            "product_level": "4digit"
+        },
+    },
+    "msa_year": {
+        "dataset": "trade4digit_province",
+        "facet": ("location_id", "year"),
+        "attrs": {
+            "sql_table_name": "msa_year",
+            "location_level": "msa",
+        },
+    },
+    "country_country_year": {
+        "dataset": "trade4digit_rcpy_country",
+        "facet": ("country_id", "location_id", "year"),
+        "attrs": {
+            "sql_table_name": "country_country_year",
+            "location_level": "country",
+            "country_level": "country",
+        },
+    },
+    "partner_product_year": {
+        "dataset": "trade4digit_rcpy_country",
+        "facet": ("product_id", "country_id", "year"),
+        "attrs": {
+            "sql_table_name": "partner_product_year",
+            "country_level": "country",
+            "product_level": "4digit"
+        },
+    },
+    "country_country_product_year": {
+        "dataset": "trade4digit_rcpy_country",
+        "facet": ("country_id", "location_id", "product_id", "year"),
+        "attrs": {
+            # Removed because we don't need to ingest this for the API
+            #"sql_table_name": "country_country_product_year",
+            "country_level": "country",
+            "location_level": "country",
+            "product_level": "4digit"
+        },
+    },
+    "country_department_year": {
+        "dataset": "trade4digit_rcpy_department",
+        "facet": ("country_id", "location_id", "year"),
+        "attrs": {
+            "sql_table_name": "country_department_year",
+            "location_level": "department",
+            "country_level": "country",
+        },
+    },
+    "country_department_product_year": {
+        "dataset": "trade4digit_rcpy_department",
+        "facet": ("country_id", "location_id", "product_id", "year"),
+        "attrs": {
+            "sql_table_name": "country_department_product_year",
+            "country_level": "country",
+            "location_level": "department",
+            "product_level": "4digit"
+        },
+    },
+    "country_msa_year": {
+        "dataset": "trade4digit_rcpy_province",
+        "facet": ("country_id", "location_id", "year"),
+        "attrs": {
+            "sql_table_name": "country_msa_year",
+            "location_level": "msa",
+            "country_level": "country",
+        },
+    },
+    "country_msa_product_year": {
+        "dataset": "trade4digit_rcpy_province",
+        "facet": ("country_id", "location_id", "product_id", "year"),
+        "attrs": {
+            "sql_table_name": "country_msa_product_year",
+            "country_level": "country",
+            "location_level": "msa",
+            "product_level": "4digit"
+        },
+    },
+    "/classifications/product": {
+        "requires": [],
+        "build_function": classification_table(product_classification),
+        "attrs": {
+            "sql_table_name": "product",
+        },
+    },
+    "/classifications/location": {
+        "requires": [],
+        "build_function": classification_table(location_classification),
+        "attrs": {
+            "sql_table_name": "location",
+        },
+    },
+    "/classifications/country": {
+        "requires": [],
+        "build_function": classification_table(country_classification),
+        "attrs": {
+            "sql_table_name": "country",
+        },
+    },
+}
 
-    # Location Classification
-    df = location_classification.table.reset_index()
 
-    df.to_hdf(store, "/classifications/location", format="table")
-    attrs = {
-        "sql_table_name": "location",
-    }
-    store.get_storer("/classifications/location").attrs.atlas_metadata = attrs
+def rollup_table(table_name, source_facet, level, verify_dataset):
+    """Build function for a table of the rcpy exports of a coarser level of
+    locations, summed up the location hierarchy from the province data.
+    If verify_dataset (the dataset read from that level's own file) was
+    processed too, the result is checked against it."""
+    target_facet = TABLES[table_name]["facet"]
+
+    def build(results):
+        mapping = ancestor_ids(location_classification, "msa", level)
+        derived = rollup_hierarchy(
+            results["trade4digit_rcpy_province"][source_facet], "location_id",
+            mapping, target_facet, ["export_value"])
+        if verify_dataset in results:
+            compare_rollup(table_name, derived,
+                           results[verify_dataset][target_facet])
+        return derived.reset_index()
+    return build
+
+
+# The rcpy files only have export values, which add up, so the department
+# and country level tables can be derived from the province file instead of
+# reading the other two. Which (smallest) province facet each one is summed
+# from, and at what level:
+ROLLUPS = {
+    "country_country_year": (("country_id", "location_id", "year"), "country"),
+    "partner_product_year": (("country_id", "location_id", "product_id", "year"), "country"),
+    "country_country_product_year": (("country_id", "location_id", "product_id", "year"), "country"),
+    "country_department_year": (("country_id", "location_id", "year"), "department"),
+    "country_department_product_year": (("country_id", "location_id", "product_id", "year"), "department"),
+}
 
-    # Country Classification
-    df = country_classification.table.reset_index()
 
-    df.to_hdf(store, "/classifications/country", format="table")
-    attrs = {
-        "sql_table_name": "country",
-    }
-    store.get_storer("/classifications/country").attrs.atlas_metadata = attrs
+def hierarchy_rollup_tables(tables, verify=False):
+    """A copy of tables where the ROLLUPS tables are summed up from the
+    province data. With verify, the datasets they'd otherwise come from are
+    still processed, to compare against."""
+    tables = dict(tables)
+    for table_name, (source_facet, level) in ROLLUPS.items():
+        table = tables[table_name]
+        requires = ["trade4digit_rcpy_province"]
+        if verify:
+            requires.append(table["dataset"])
+        tables[table_name] = {
+            "requires": requires,
+            "build_function": rollup_table(table_name, source_facet, level,
+                                           table["dataset"]),
+            "attrs": table["attrs"],
+        }
+        if "hdf_layout" in DATASETS[table["dataset"]]:
+            tables[table_name]["hdf_layout"] = DATASETS[table["dataset"]]["hdf_layout"]
+    return tables
 
-    store.close()
 
+if __name__ == "__main__":
+    import argparse
+    import time
+    import pipeline
+
+    parser = argparse.ArgumentParser(description="Build data.h5 from the Peru datasets.")
+    parser.add_argument("-j", "--processes", type=int, default=None,
+                        help="Number of datasets to process at once (default: number of CPUs)")
+    parser.add_argument("--force", action="store_true",
+                        help="Rebuild every table, even if it's up to date")
+    parser.add_argument("-o", "--output", default="data.h5",
+                        help="HDF store (.h5) or Parquet directory to write to (default: data.h5)")
+    parser.add_argument("--report", default=None,
+                        help="Path prefix for the per-stage timing report (default: reports/build-<time>)")
+    parser.add_argument("--rollup", choices=["off", "on", "verify"], default="off",
+                        help="Derive the department and country rcpy tables from the "
+                             "province data instead of their own files, or do both and "
+                             "compare (default: off)")
+    parser.add_argument("--stream", nargs="?", type=int, const=RCPY_CHUNKSIZE,
+                        default=None, metavar="ROWS",
+                        help="Read the rcpy datasets in chunks of ROWS rows (default: "
+                             "{}) to bound memory, skipping the input cache and the "
+                             "whole dataset checks".format(RCPY_CHUNKSIZE))
+    args = parser.parse_args()
+
+    datasets = DATASETS
+    if args.stream:
+        datasets = streaming_datasets(DATASETS, args.stream)
+
+    tables = TABLES
+    if args.rollup != "off":
+        tables = hierarchy_rollup_tables(TABLES, verify=args.rollup == "verify")
+
+    report_prefix = args.report
+    if report_prefix is None:
+        os.makedirs("reports", exist_ok=True)
+        report_prefix = os.path.join(
+            "reports", time.strftime("build-%Y%m%d-%H%M%S"))
+
+    pipeline.run_pipeline(datasets, tables, args.output,
+                          processes=args.processes, force=args.force,
+                          report_prefix=report_prefix)
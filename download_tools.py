@@ -0,0 +1,222 @@
+import io
+import os
+import zlib
+import concurrent.futures
+
+import pandas as pd
+import xlsxwriter
+
+import output
+
+
+# Rows of the base table to join and write at a time
+CHUNKSIZE = 200000
+
+EXCEL_MAX_ROWS = 1048576
+
+# Threads compressing each CSV, and how much CSV text goes in each
+# independently compressed gzip member
+GZIP_THREADS = 4
+GZIP_BLOCK_SIZE = 8 * 1024 * 1024
+GZIP_LEVEL = 6
+
+
+def index_keys(df, on):
+    """The values of the on columns of df as an index to look up."""
+    if len(on) == 1:
+        return pd.Index(df[on[0]].values, name=on[0])
+    return pd.MultiIndex.from_arrays([df[c].values for c in on], names=on)
+
+
+def join_lookup(df, lookup, on):
+    """Inner join df with a lookup table that's indexed by the on columns.
+    Rows are matched by index position rather than with a merge, so the
+    lookup's hash table is built once and reused for every chunk."""
+    positions = lookup.index.get_indexer(index_keys(df, on))
+    found = positions >= 0
+    if not found.all():
+        df = df[found]
+        positions = positions[found]
+
+    return pd.concat([df.reset_index(drop=True),
+                      lookup.iloc[positions].reset_index(drop=True)],
+                     axis=1)
+
+
+def load_classifications(data):
+    """Label columns of each classification, indexed by id and keyed by the
+    name of the id column they label."""
+    classifications = {}
+    for key in data.tables():
+        if key.startswith('/classifications/'):
+
+            name = data.metadata(key)['sql_table_name']
+
+            # Customize table to be ready for merging
+            if name == "location":
+                columns = ["code", "name"]
+            else:
+                columns = ["code", "name", "name_es"]
+            table = data.read(key, columns=["index"] + columns)
+            table = table.set_index("index")
+            table.columns = [name + "_" + col for col in table.columns]
+
+            classifications[name + "_id"] = table
+    return classifications
+
+
+class DownloadEngine(object):
+    """Builds downloads from declarative specs:
+
+        {
+            "table": base table to stream,
+            "columns": optional subset of base table columns,
+            "joins": [{"table": ..., "columns": [...], "on": [...]}, ...],
+            "labels": id columns to replace with classification labels,
+        }
+
+    Every join table and the classifications are read and indexed once per
+    run and shared by all the downloads that use them. Call prepare() before
+    forking workers so they inherit the shared intermediates; each process
+    opens its own handle on the data."""
+
+    def __init__(self, data_path):
+        self.data_path = data_path
+        self._data = None
+        self._data_pid = None
+        self._lookups = {}
+        self._classifications = None
+
+    @property
+    def data(self):
+        if self._data is None or self._data_pid != os.getpid():
+            self._data = output.open_output(self.data_path, mode="r")
+            self._data_pid = os.getpid()
+        return self._data
+
+    def close(self):
+        if self._data is not None and self._data_pid == os.getpid():
+            self._data.close()
+        self._data = None
+
+    def lookup(self, join):
+        key = (join["table"], tuple(join["columns"]), tuple(join["on"]))
+        if key not in self._lookups:
+            df = self.data.read(join["table"], columns=join["columns"])
+            df = df.set_index(join["on"])
+            if not df.index.is_unique:
+                raise ValueError("Can't join {} on non unique keys {}"
+                                 .format(join["table"], join["on"]))
+            self._lookups[key] = df
+        return self._lookups[key]
+
+    @property
+    def classifications(self):
+        if self._classifications is None:
+            self._classifications = load_classifications(self.data)
+        return self._classifications
+
+    def prepare(self, specs):
+        """Read all the intermediates the given downloads need."""
+        self.classifications
+        for spec in specs:
+            for join in spec.get("joins", []):
+                self.lookup(join)
+
+    def attach_labels(self, df, labels):
+        for col in list(df.columns):
+            if col in labels:
+                df = join_lookup(df, self.classifications[col], [col])
+                df = df.drop(col, axis=1)
+        return df
+
+    def frames(self, spec):
+        """Stream the download in chunks of the base table."""
+        chunks = self.data.read_chunks(spec["table"], CHUNKSIZE,
+                                       columns=spec.get("columns"))
+        for chunk in chunks:
+            for join in spec.get("joins", []):
+                chunk = join_lookup(chunk, self.lookup(join), join["on"])
+            yield self.attach_labels(chunk, spec.get("labels", []))
+
+
+def write_workbook(path, frames):
+    """Write frames with the same columns one after the other into a single
+    worksheet. Rows are streamed with xlsxwriter's constant_memory mode, so
+    neither the whole table nor the whole workbook is ever in memory."""
+    workbook = xlsxwriter.Workbook(path, {"constant_memory": True})
+    worksheet = workbook.add_worksheet()
+    header_format = workbook.add_format({"bold": True})
+
+    row = 0
+    try:
+        for df in frames:
+            if row == 0:
+                worksheet.write_row(0, 0, list(df.columns), header_format)
+                row = 1
+
+            if row + len(df) > EXCEL_MAX_ROWS:
+                raise ValueError("{} has more rows than fit in a worksheet."
+                                 .format(path))
+
+            # Python scalars with None for missing values, which xlsxwriter
+            # leaves blank
+            values = df.astype(object).where(df.notnull(), None).values.tolist()
+            for values_row in values:
+                worksheet.write_row(row, 0, values_row)
+                row += 1
+    finally:
+        workbook.close()
+
+    # Not counting the header
+    return max(row - 1, 0)
+
+
+def gzip_member(data, level=GZIP_LEVEL):
+    """Compress data as a complete gzip member. Members can be concatenated
+    into one valid .gz file, which is what lets blocks be compressed
+    independently (like pigz)."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def csv_blocks(frames, block_size=GZIP_BLOCK_SIZE):
+    """CSV text of frames with the same columns, with a single header, in
+    blocks of about block_size bytes."""
+    buffer = io.StringIO()
+    header = True
+    for df in frames:
+        df.to_csv(buffer, header=header, index=False)
+        header = False
+        if buffer.tell() >= block_size:
+            yield buffer.getvalue().encode("utf-8")
+            buffer = io.StringIO()
+    if buffer.tell() > 0:
+        yield buffer.getvalue().encode("utf-8")
+
+
+def write_csv_gzip(path, frames, threads=GZIP_THREADS,
+                   block_size=GZIP_BLOCK_SIZE):
+    """Write frames with the same columns as one gzipped CSV. Rows are
+    formatted in chunks on this thread while blocks are compressed on
+    others (zlib releases the GIL); the members are written in order as
+    they finish. Returns the row count, not counting the header."""
+    rows = [0]
+
+    def counted(frames):
+        for df in frames:
+            rows[0] += len(df)
+            yield df
+
+    pending = []
+    with open(path, "wb") as f, \
+            concurrent.futures.ThreadPoolExecutor(threads) as executor:
+        for block in csv_blocks(counted(frames), block_size):
+            pending.append(executor.submit(gzip_member, block))
+            # Bound the number of blocks in memory
+            while len(pending) > 2 * threads:
+                f.write(pending.pop(0).result())
+        for future in pending:
+            f.write(future.result())
+
+    return rows[0]
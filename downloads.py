@@ -1,92 +1,142 @@
-import pandas as pd
+import os
+import multiprocessing
+import concurrent.futures
 
-store = pd.HDFStore("data.h5")
+from download_tools import DownloadEngine, write_workbook, write_csv_gzip
+from dataset_tools import good, bad
 
 
-classifications = {}
-for key in store:
-    if key.startswith('/classifications/'):
+DOWNLOADS_DIR = "downloads"
 
-        name = store.get_storer(key).attrs.atlas_metadata['sql_table_name']
-        table = store[key]
-
-        # Customize table to be ready for merging
-        table = table.set_index("index")
-        if name == "location":
-            table = table[["code", "name"]]
-        else:
-            table = table[["code", "name", "name_es"]]
-        table.columns = [name + "_" + col for col in table.columns]
-
-        classifications[name + "_id"] = table
-
-
-def merge_classifications(df):
-    for col in df.columns:
-        if col in classifications:
-            df = df.merge(classifications[col], left_on=col, right_index=True)
-            df = df.drop(col, axis=1)
-    return df
-
-py = store['product_year'][['product_id', 'year', 'pci']]
+# Each download can be written as an Excel workbook and as a gzipped CSV,
+# the CSVs are uploaded with Content-Encoding: gzip by publish.py
+WRITERS = {
+    "xlsx": write_workbook,
+    "csv": write_csv_gzip,
+}
 
 location_year_columns = ['location_id', 'year', 'eci', 'coi']
-cy = store['country_year'][location_year_columns]
-dy = store['department_year'][location_year_columns]
-my = store['msa_year'][location_year_columns]
-
-pd.set_option("io.excel.xlsx.writer", "xlsxwriter")
-
-cpy = store['country_product_year']\
-    .merge(cy, on=['location_id', 'year'])\
-    .merge(py, on=['product_id', 'year'])
-merge_classifications(cpy)\
-    .to_excel("downloads/products_country.xlsx", index=False)
-
-
-dpy = store['department_product_year']\
-    .merge(dy, on=['location_id', 'year'])\
-    .merge(py, on=['product_id', 'year'])
-merge_classifications(dpy)\
-    .to_excel("downloads/products_department.xlsx", index=False)
-
-
-ppy = store['msa_product_year']\
-    .merge(my, on=['location_id', 'year'])\
-    .merge(py, on=['product_id', 'year'])
-merge_classifications(ppy)\
-    .to_excel("downloads/products_province.xlsx", index=False)
-
-
-ccpy = store['country_country_product_year']\
-    .merge(cy, on=['location_id', 'year'])\
-    .merge(py, on=['product_id', 'year'])\
-    .merge(cpy[["location_id", "product_id", "year", "cog"]],
-           on=['location_id', 'product_id', 'year'])
-ccpy = merge_classifications(ccpy)
-ccpy.to_excel("downloads/products_rcpy_country.xlsx", index=False)
-
-
-cdpy = store['country_department_product_year']\
-    .merge(dy, on=['location_id', 'year'])\
-    .merge(py, on=['product_id', 'year'])\
-    .merge(dpy[["location_id", "product_id", "year", "cog"]],
-           on=['location_id', 'product_id', 'year'])
-cdpy = merge_classifications(cdpy)
-cdpy.to_excel("downloads/products_rcpy_department.xlsx", index=False)
-
-
-cmpy = store['country_msa_product_year']\
-    .merge(my, on=['location_id', 'year'])\
-    .merge(py, on=['product_id', 'year'])\
-    .merge(ppy[["location_id", "product_id", "year", "cog"]],
-           on=['location_id', 'product_id', 'year'])
-cmpy = merge_classifications(cmpy)
-cmpy.to_excel("downloads/products_rcpy_province.xlsx", index=False)
-
-
-demographics_department = store['department_year']\
-    [["location_id", "year", "gdp_real", "gdp_pc_real", "gdp_nominal", "gdp_pc_nominal", "population"]]\
-    .merge(dy, on=['location_id', 'year'])
-demographics_department = merge_classifications(demographics_department)
-demographics_department.to_excel("downloads/demographics_department.xlsx", index=False)
+product_year_columns = ['product_id', 'year', 'pci']
+cog_columns = ['location_id', 'product_id', 'year', 'cog']
+
+
+def location_year(table):
+    return {
+        "table": table,
+        "columns": location_year_columns,
+        "on": ['location_id', 'year'],
+    }
+
+
+product_year = {
+    "table": 'product_year',
+    "columns": product_year_columns,
+    "on": ['product_id', 'year'],
+}
+
+
+def cog(table):
+    return {
+        "table": table,
+        "columns": cog_columns,
+        "on": ['location_id', 'product_id', 'year'],
+    }
+
+
+DOWNLOADS = {
+    "products_country": {
+        "table": 'country_product_year',
+        "joins": [location_year('country_year'), product_year],
+        "labels": ['location_id', 'product_id'],
+    },
+    "products_department": {
+        "table": 'department_product_year',
+        "joins": [location_year('department_year'), product_year],
+        "labels": ['location_id', 'product_id'],
+    },
+    "products_province": {
+        "table": 'msa_product_year',
+        "joins": [location_year('msa_year'), product_year],
+        "labels": ['location_id', 'product_id'],
+    },
+    "products_rcpy_country": {
+        "table": 'country_country_product_year',
+        "joins": [location_year('country_year'), product_year,
+                  cog('country_product_year')],
+        "labels": ['country_id', 'location_id', 'product_id'],
+    },
+    "products_rcpy_department": {
+        "table": 'country_department_product_year',
+        "joins": [location_year('department_year'), product_year,
+                  cog('department_product_year')],
+        "labels": ['country_id', 'location_id', 'product_id'],
+    },
+    "products_rcpy_province": {
+        "table": 'country_msa_product_year',
+        "joins": [location_year('msa_year'), product_year,
+                  cog('msa_product_year')],
+        "labels": ['country_id', 'location_id', 'product_id'],
+    },
+    "demographics_department": {
+        "table": 'department_year',
+        "columns": ["location_id", "year", "gdp_real", "gdp_pc_real",
+                    "gdp_nominal", "gdp_pc_nominal", "population"],
+        "joins": [location_year('department_year')],
+        "labels": ['location_id'],
+    },
+}
+
+
+# Filled in by the parent before forking, see generate_download
+_ENGINE = None
+
+
+def generate_download(name, file_format="xlsx"):
+    """Write one download. Runs in a worker process forked after the shared
+    intermediates were prepared in the parent."""
+    path = os.path.join(DOWNLOADS_DIR, name + "." + file_format)
+    try:
+        return WRITERS[file_format](path, _ENGINE.frames(DOWNLOADS[name]))
+    finally:
+        _ENGINE.close()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Generate the Excel and CSV downloads.")
+    parser.add_argument("data", nargs="?", default="data.h5",
+                        help="data.h5 or a Parquet output directory (default: data.h5)")
+    parser.add_argument("-j", "--processes", type=int, default=None,
+                        help="Number of files to write at once (default: number of CPUs)")
+    parser.add_argument("--only", nargs="+", choices=sorted(DOWNLOADS),
+                        help="Only generate these downloads")
+    parser.add_argument("--formats", nargs="+", choices=sorted(WRITERS),
+                        default=sorted(WRITERS),
+                        help="File formats to write (default: all)")
+    args = parser.parse_args()
+
+    names = args.only or list(DOWNLOADS)
+
+    _ENGINE = DownloadEngine(args.data)
+    _ENGINE.prepare([DOWNLOADS[name] for name in names])
+    _ENGINE.close()
+
+    # Workers have to be forked to inherit _ENGINE
+    with concurrent.futures.ProcessPoolExecutor(
+            args.processes,
+            mp_context=multiprocessing.get_context("fork")) as executor:
+        futures = {
+            executor.submit(generate_download, name, file_format):
+            "{}.{}".format(name, file_format)
+            for name in names
+            for file_format in args.formats
+        }
+        for future in concurrent.futures.as_completed(futures):
+            file_name = futures[future]
+            try:
+                rows = future.result()
+            except Exception:
+                bad("Download {} failed!".format(file_name))
+                raise
+            good("Wrote {} ({} rows).".format(file_name, rows))
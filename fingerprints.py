@@ -0,0 +1,100 @@
+"""Fingerprints of everything that goes into an output table: the source
+files, the dataset and table configs (including the code of hooks and
+aggregation functions), the classifications and the processing code. A table
+whose stored fingerprint matches doesn't need to be rebuilt."""
+
+import hashlib
+import importlib
+import types
+
+import input_cache
+from classification_cache import CachedClassification
+
+
+# Changes to these modules change how every dataset is processed or how
+# tables are built and written. By name, since pipeline imports this module.
+CODE_MODULES = [
+    "dataset_tools",
+    "compaction",
+    "validation",
+    "classification_cache",
+    "pipeline",
+    "output",
+]
+
+
+def _sha1(s):
+    return hashlib.sha1(s.encode("utf-8")).hexdigest()
+
+
+def code_token(code):
+    """Describe a code object by its bytecode, names and constants. Nested
+    code objects (lambdas, comprehensions) are described recursively since
+    their repr includes a memory address."""
+    consts = []
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            consts.append(code_token(const))
+        else:
+            consts.append(repr(const))
+    return _sha1(repr((code.co_code, code.co_names, consts)))
+
+
+def function_token(f):
+    token = "{}.{}:{}".format(f.__module__, f.__qualname__,
+                              code_token(f.__code__))
+    if f.__closure__:
+        token += "(" + ",".join(config_token(cell.cell_contents)
+                                for cell in f.__closure__) + ")"
+    # Values captured as default arguments, e.g. lambda x, y=y: ...
+    if f.__defaults__:
+        token += "defaults" + config_token(f.__defaults__)
+    if f.__kwdefaults__:
+        token += "kwdefaults" + config_token(f.__kwdefaults__)
+    return token
+
+
+def config_token(obj):
+    """Stable string description of a dataset or table config value."""
+    if isinstance(obj, dict):
+        items = sorted((config_token(k), config_token(v))
+                       for k, v in obj.items())
+        return "{" + ",".join(k + ":" + v for k, v in items) + "}"
+    if isinstance(obj, (list, tuple)):
+        return "[" + ",".join(config_token(x) for x in obj) + "]"
+    if isinstance(obj, CachedClassification) or \
+            isinstance(getattr(obj, "source_hash", None), str):
+        return "classification:" + obj.source_hash
+    if isinstance(obj, types.FunctionType):
+        return "function:" + function_token(obj)
+    return repr(obj)
+
+
+_code_fingerprint = None
+
+
+def code_fingerprint():
+    global _code_fingerprint
+    if _code_fingerprint is None:
+        _code_fingerprint = _sha1(",".join(
+            input_cache.file_hash(importlib.import_module(module).__file__)
+            for module in CODE_MODULES))
+    return _code_fingerprint
+
+
+def dataset_fingerprint(dataset):
+    """Fingerprint of a dataset, or None if its input can't be fingerprinted
+    (a custom read_function), in which case it's always considered stale."""
+    if "read_function" in dataset:
+        return None
+    source = input_cache.source_fingerprint(dataset["source_file"])
+    return _sha1(source + config_token(dataset) + code_fingerprint())
+
+
+def table_fingerprint(table, dataset_fingerprints):
+    parts = [config_token(table)]
+    for requirement in sorted(dataset_fingerprints):
+        if dataset_fingerprints[requirement] is None:
+            return None
+        parts.append(requirement + ":" + dataset_fingerprints[requirement])
+    return _sha1(",".join(parts))
@@ -0,0 +1,162 @@
+"""Local disk cache of parsed input files, keyed on the content hash of the
+source file. Frames are stored as feather if pyarrow is installed, pickle
+otherwise."""
+
+import os
+import json
+import hashlib
+import tempfile
+
+import pandas as pd
+
+try:
+    import pyarrow.feather as feather
+except ImportError:
+    feather = None
+
+
+CACHE_DIR = os.environ.get(
+    "PERU_INGESTION_CACHE_DIR",
+    os.path.join(os.path.expanduser("~"), ".cache", "peru-ingestion", "inputs"))
+
+# Least recently used entries are evicted beyond this size
+CACHE_MAX_BYTES = int(os.environ.get("PERU_INGESTION_CACHE_MAX_BYTES",
+                                     20 * 1024 ** 3))
+
+CACHE_ENABLED = os.environ.get("PERU_INGESTION_CACHE", "on") != "off"
+
+HASH_BLOCK_SIZE = 8 * 1024 * 1024
+
+
+def file_hash(path):
+    """SHA1 of the contents of a file."""
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def atomic_write(path, write_function):
+    """Write via a temp file in the same directory and rename into place, so
+    that concurrent workers never see a half written entry."""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    os.close(fd)
+    try:
+        write_function(tmp_path)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def source_fingerprint(path, cache_dir=None):
+    """Return the content hash of a source file, reusing the remembered hash
+    when path, size and mtime all match."""
+    cache_dir = cache_dir or CACHE_DIR
+    stat_dir = os.path.join(cache_dir, "stat")
+    os.makedirs(stat_dir, exist_ok=True)
+
+    path = os.path.abspath(path)
+    st = os.stat(path)
+    stat_key = {"path": path, "size": st.st_size, "mtime_ns": st.st_mtime_ns}
+
+    stat_file = os.path.join(
+        stat_dir, hashlib.sha1(path.encode("utf-8")).hexdigest() + ".json")
+
+    if os.path.exists(stat_file):
+        with open(stat_file) as f:
+            remembered = json.load(f)
+        if all(remembered.get(k) == v for k, v in stat_key.items()):
+            return remembered["hash"]
+
+    stat_key["hash"] = file_hash(path)
+
+    def write(tmp_path):
+        with open(tmp_path, "w") as f:
+            json.dump(stat_key, f)
+    atomic_write(stat_file, write)
+
+    return stat_key["hash"]
+
+
+def _entry_path(cache_dir, key):
+    extension = ".feather" if feather is not None else ".pkl"
+    return os.path.join(cache_dir, "frames", key + extension)
+
+
+def _load_entry(entry_path):
+    if entry_path.endswith(".feather"):
+        return feather.read_feather(entry_path)
+    return pd.read_pickle(entry_path)
+
+
+def _save_entry(entry_path, df):
+    if entry_path.endswith(".feather"):
+        # Feather only stores default indexes
+        atomic_write(entry_path,
+                      lambda p: feather.write_feather(df.reset_index(drop=True), p))
+    else:
+        atomic_write(entry_path, lambda p: df.to_pickle(p))
+
+
+def evict(cache_dir=None, max_bytes=None):
+    """Remove least recently used frames until the cache fits in max_bytes."""
+    cache_dir = cache_dir or CACHE_DIR
+    max_bytes = CACHE_MAX_BYTES if max_bytes is None else max_bytes
+
+    frames_dir = os.path.join(cache_dir, "frames")
+    if not os.path.isdir(frames_dir):
+        return
+
+    entries = []
+    for name in os.listdir(frames_dir):
+        if name.endswith(".tmp"):
+            continue
+        path = os.path.join(frames_dir, name)
+        st = os.stat(path)
+        entries.append((st.st_mtime, st.st_size, path))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+
+def cached_read(path, read_function, reader_key="", cache_dir=None):
+    """Return read_function(path), from the cache if the file at path hasn't
+    changed since it was last parsed. reader_key should identify the reader
+    and its options, so different parses of the same file don't collide."""
+
+    if not CACHE_ENABLED:
+        return read_function(path)
+
+    cache_dir = cache_dir or CACHE_DIR
+    os.makedirs(os.path.join(cache_dir, "frames"), exist_ok=True)
+
+    content_hash = source_fingerprint(path, cache_dir=cache_dir)
+    key = hashlib.sha1(
+        (content_hash + reader_key).encode("utf-8")).hexdigest()
+    entry_path = _entry_path(cache_dir, key)
+
+    if os.path.exists(entry_path):
+        # Bump mtime so eviction is least recently *used*
+        os.utime(entry_path)
+        return _load_entry(entry_path)
+
+    df = read_function(path)
+    _save_entry(entry_path, df)
+    evict(cache_dir)
+    return df
+
+
+def read_stata_cached(path, **kwargs):
+    """Cached pd.read_stata."""
+    reader_key = "read_stata:" + json.dumps(kwargs, sort_keys=True)
+    return cached_read(path, lambda p: pd.read_stata(p, **kwargs),
+                       reader_key=reader_key)
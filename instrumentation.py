@@ -0,0 +1,60 @@
+"""Timing and memory records for each stage of processing a dataset, written
+out as a JSON / CSV report per run so that runs can be compared."""
+
+import csv
+import json
+import time
+import resource
+from contextlib import contextmanager
+
+
+FIELDS = ["dataset", "stage", "wall_seconds", "cpu_seconds",
+          "peak_rss_delta_kb", "rows_in", "rows_out"]
+
+# Records of the stages run so far in this process
+_records = []
+
+
+def _peak_rss_kb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+@contextmanager
+def stage(name, rows_in=None):
+    """Time a stage of processing. Set "rows_out" on the yielded record to
+    report the size of its result. The peak RSS delta is how much the
+    process' high water mark grew during the stage."""
+    record = {"stage": name, "rows_in": rows_in, "rows_out": None}
+
+    wall_start = time.time()
+    cpu_start = time.process_time()
+    rss_start = _peak_rss_kb()
+    try:
+        yield record
+    finally:
+        record["wall_seconds"] = time.time() - wall_start
+        record["cpu_seconds"] = time.process_time() - cpu_start
+        record["peak_rss_delta_kb"] = _peak_rss_kb() - rss_start
+        _records.append(record)
+
+
+def collect(dataset=None):
+    """Take the records gathered so far, tagging them with a dataset name."""
+    records = list(_records)
+    del _records[:]
+    for record in records:
+        record["dataset"] = dataset
+    return records
+
+
+def write_report(records, path_prefix):
+    """Write records to path_prefix.json and path_prefix.csv."""
+    with open(path_prefix + ".json", "w") as f:
+        json.dump(records, f, indent=2, default=str)
+
+    with open(path_prefix + ".csv", "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=FIELDS, extrasaction="ignore")
+        writer.writeheader()
+        for record in records:
+            writer.writerow(record)
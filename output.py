@@ -0,0 +1,244 @@
+"""Where built tables go: either the usual HDF5 store or a directory of
+Parquet files partitioned by year. Both take (table name, frame, metadata)
+and can read back just some columns and years of a table."""
+
+import os
+import json
+import shutil
+
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+
+PARTITION_COLUMN = "year"
+
+# Columns written as indexed data_columns in HDF stores, so that reads can
+# select rows by them without loading whole tables
+INDEX_COLUMNS = ["location_id", "product_id", "country_id", "year"]
+
+# Per table HDF layout settings that can be given to write(). chunkshape
+# isn't exposed by pandas, PyTables derives it from expectedrows.
+HDF_LAYOUT_KEYS = ["expectedrows", "complevel", "complib"]
+
+# Rows appended to an HDF table at a time
+HDF_WRITE_CHUNKSIZE = 1000000
+
+
+def _normalize_name(name):
+    return "/" + name.strip("/")
+
+
+def _merge_filters(years, filters):
+    """Combine the years shortcut with {column: values} filters."""
+    filters = dict(filters or {})
+    if years is not None:
+        filters[PARTITION_COLUMN] = years
+    return filters
+
+
+def _hdf_where(filters):
+    # Plain python values, the HDF query parser doesn't know numpy scalars
+    return ["{} == {!r}".format(column, np.asarray(values).tolist())
+            for column, values in filters.items()]
+
+
+class HDFOutput(object):
+    """Tables in a PyTables HDFStore, metadata in the atlas_metadata attr."""
+
+    def __init__(self, path, complib="blosc", mode="a"):
+        self.path = path
+        self.complib = complib
+        self.store = pd.HDFStore(path, complib=complib, mode=mode)
+
+    def tables(self):
+        return list(self.store.keys())
+
+    def metadata(self, name):
+        if name not in self.store:
+            return None
+        return getattr(self.store.get_storer(name).attrs, "atlas_metadata", None)
+
+    def write(self, name, df, metadata, layout=None):
+        """Replace a table. layout can set HDF_LAYOUT_KEYS for this table,
+        by default the store's compression is used and expectedrows is the
+        length of df."""
+        layout = dict(layout or {})
+        unknown = set(layout) - set(HDF_LAYOUT_KEYS)
+        if unknown:
+            raise ValueError("Unknown HDF layout settings {}"
+                             .format(sorted(unknown)))
+        layout.setdefault("expectedrows", max(len(df), 1))
+        if "complevel" in layout:
+            # pandas ignores complevel without a complib
+            layout.setdefault("complib", self.complib)
+
+        data_columns = [c for c in INDEX_COLUMNS if c in df.columns]
+        if name in self.store:
+            self.store.remove(name)
+        self.store.append(name, df, format="table", data_columns=data_columns,
+                          index=False, chunksize=HDF_WRITE_CHUNKSIZE, **layout)
+        if data_columns:
+            self.store.create_table_index(name, columns=data_columns,
+                                          optlevel=9, kind="full")
+        self.store.get_storer(name).attrs.atlas_metadata = metadata
+
+    def read(self, name, columns=None, years=None, filters=None):
+        """Read a table, or only some of its columns and the rows where each
+        column in filters is one of the given values. Filtering happens in
+        PyTables on the indexed data_columns."""
+        where = _hdf_where(_merge_filters(years, filters)) or None
+        return self.store.select(name, columns=columns, where=where)
+
+    def read_chunks(self, name, chunksize, columns=None, filters=None):
+        """Iterate over a table chunksize rows at a time."""
+        where = _hdf_where(filters or {}) or None
+        return iter(self.store.select(name, columns=columns, where=where,
+                                      chunksize=chunksize))
+
+    def close(self):
+        self.store.close()
+
+
+class ParquetOutput(object):
+    """Each table is a directory under root, split into one Parquet file per
+    year (or a single file if it has no year column). Metadata is stored as
+    JSON in the footer of every file."""
+
+    FILE_NAME = "part-0.parquet"
+    METADATA_KEY = b"atlas_metadata"
+
+    def __init__(self, root):
+        if pq is None:
+            raise ImportError("The parquet output needs pyarrow installed.")
+        self.path = root
+        os.makedirs(root, exist_ok=True)
+
+    def _table_dir(self, name):
+        return os.path.join(self.path, *name.strip("/").split("/"))
+
+    def _files(self, name, years=None):
+        table_dir = self._table_dir(name)
+        if not os.path.isdir(table_dir):
+            return []
+
+        single = os.path.join(table_dir, self.FILE_NAME)
+        if os.path.exists(single):
+            return [single]
+
+        prefix = PARTITION_COLUMN + "="
+        years = None if years is None else set(int(y) for y in years)
+        files = []
+        for partition in sorted(os.listdir(table_dir)):
+            if not partition.startswith(prefix):
+                continue
+            if years is not None and int(partition[len(prefix):]) not in years:
+                continue
+            files.append(os.path.join(table_dir, partition, self.FILE_NAME))
+        return files
+
+    def tables(self):
+        tables = []
+        for dirpath, dirnames, filenames in os.walk(self.path):
+            if self.FILE_NAME in filenames and \
+                    not os.path.basename(dirpath).startswith(PARTITION_COLUMN + "="):
+                tables.append(dirpath)
+            elif any(d.startswith(PARTITION_COLUMN + "=") for d in dirnames):
+                tables.append(dirpath)
+                dirnames[:] = []
+        return sorted(_normalize_name(os.path.relpath(t, self.path))
+                      for t in tables)
+
+    def metadata(self, name):
+        files = self._files(name)
+        if not files:
+            return None
+        schema_metadata = pq.read_schema(files[0]).metadata or {}
+        if self.METADATA_KEY not in schema_metadata:
+            return None
+        return json.loads(schema_metadata[self.METADATA_KEY].decode("utf-8"))
+
+    def _write_file(self, path, df, metadata):
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        schema_metadata = dict(table.schema.metadata or {})
+        schema_metadata[self.METADATA_KEY] = json.dumps(metadata).encode("utf-8")
+        pq.write_table(table.replace_schema_metadata(schema_metadata), path)
+
+    def write(self, name, df, metadata, layout=None):
+        # HDF layout settings don't apply here.
+        # Write next to the old version and swap it in when done
+        table_dir = self._table_dir(name)
+        tmp_dir = table_dir + ".tmp"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+
+        if PARTITION_COLUMN in df.columns:
+            for year, year_df in df.groupby(PARTITION_COLUMN):
+                partition_dir = os.path.join(
+                    tmp_dir, "{}={}".format(PARTITION_COLUMN, year))
+                os.makedirs(partition_dir)
+                self._write_file(os.path.join(partition_dir, self.FILE_NAME),
+                                 year_df, metadata)
+        else:
+            self._write_file(os.path.join(tmp_dir, self.FILE_NAME),
+                             df, metadata)
+
+        shutil.rmtree(table_dir, ignore_errors=True)
+        os.rename(tmp_dir, table_dir)
+
+    def _arrow_filters(self, filters):
+        return [(column, "in", np.asarray(values).tolist())
+                for column, values in filters.items()] or None
+
+    def read(self, name, columns=None, years=None, filters=None):
+        """Read a table, or only some of its columns and the rows where each
+        column in filters is one of the given values. Years not asked for
+        aren't even opened, other filters are pushed down to pyarrow."""
+        files = self._files(name, years=years)
+        if not files:
+            if years is None:
+                raise KeyError("No table named {}".format(name))
+            return pd.DataFrame(columns=columns)
+
+        arrow_filters = self._arrow_filters(filters or {})
+        table = pa.concat_tables([
+            pq.read_table(f, columns=columns, filters=arrow_filters,
+                          use_threads=True)
+            for f in files
+        ])
+        return table.to_pandas(use_threads=True)
+
+    def read_chunks(self, name, chunksize, columns=None, filters=None):
+        """Iterate over a table at most chunksize rows at a time."""
+        filters = filters or {}
+        read_columns = columns
+        if columns is not None:
+            read_columns = list(columns) + [c for c in filters
+                                            if c not in columns]
+
+        for f in self._files(name):
+            parquet_file = pq.ParquetFile(f)
+            for batch in parquet_file.iter_batches(batch_size=chunksize,
+                                                   columns=read_columns):
+                df = batch.to_pandas()
+                for column, values in filters.items():
+                    df = df[df[column].isin(values)]
+                if columns is not None:
+                    df = df[list(columns)]
+                yield df
+
+    def close(self):
+        pass
+
+
+def open_output(path, **kwargs):
+    """Pick the backend from the path: .h5 files are HDF stores, anything
+    else is a Parquet directory. kwargs only apply to HDF stores."""
+    if path.endswith((".h5", ".hdf5", ".hdf")):
+        return HDFOutput(path, **kwargs)
+    return ParquetOutput(path)
@@ -0,0 +1,256 @@
+import os
+import queue
+import multiprocessing
+import threading
+import concurrent.futures
+
+import dataset_tools
+import classification_cache
+import fingerprints
+import instrumentation
+import output
+from dataset_tools import good, bad
+
+
+# Datasets are dicts holding lambdas and hooks, which can't be pickled over to
+# worker processes. Instead the parent fills this registry before starting the
+# pool, the (forked) workers inherit it and look datasets up by name. That
+# only works with fork, which isn't the default start method everywhere.
+_DATASETS = {}
+
+# Threads to hash the source files of the datasets on
+FINGERPRINT_THREADS = 8
+
+
+def _process_named_dataset(name):
+    result = dataset_tools.process_dataset(_DATASETS[name])
+    return result, instrumentation.collect(name)
+
+
+def table_requirements(table):
+    """Names of the datasets a table is built from."""
+    if "requires" in table:
+        return list(table["requires"])
+    return [table["dataset"]]
+
+
+def build_table(table, results):
+    """Turn processed dataset results into the frame to be written out. By
+    default this is one facet of one dataset, otherwise a custom
+    build_function(results) can combine several."""
+    if "build_function" in table:
+        return table["build_function"](results)
+    return results[table["dataset"]][table["facet"]].reset_index()
+
+
+def table_layout(table, datasets):
+    """HDF layout settings for a table: its dataset's "hdf_layout",
+    overridden by the table's own."""
+    layout = {}
+    if "dataset" in table:
+        layout.update(datasets[table["dataset"]].get("hdf_layout", {}))
+    layout.update(table.get("hdf_layout", {}))
+    return layout
+
+
+class BackgroundWriter(object):
+    """Builds and writes tables on a thread of its own, so the parent can
+    keep collecting dataset results meanwhile. Once started, nothing else
+    may touch the output until join() returns. At most max_pending tables
+    wait in the queue, put() blocks beyond that."""
+
+    def __init__(self, out, max_pending=4):
+        self.out = out
+        self.queue = queue.Queue(max_pending)
+        self.error = None
+        self.records = []
+        self.thread = threading.Thread(target=self._run, name="table-writer")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            if self.error is not None:
+                continue
+            table_name, table, results, attrs, layout = item
+            try:
+                with instrumentation.stage("write:" + table_name) as s:
+                    df = build_table(table, results)
+                    s["rows_in"] = s["rows_out"] = len(df)
+                    self.out.write(table_name, df, attrs, layout)
+                good("Wrote table: {}".format(table_name))
+            except Exception as e:
+                self.error = e
+                bad("Writing table {} failed!".format(table_name))
+            finally:
+                del item, results
+                self.records.extend(instrumentation.collect("<writer>"))
+
+    def _check(self):
+        if self.error is not None:
+            raise self.error
+
+    def put(self, table_name, table, results, attrs, layout):
+        self._check()
+        self.queue.put((table_name, table, results, attrs, layout))
+
+    def join(self):
+        """Wait for everything queued to be written, raising the first
+        error if there was one."""
+        self.queue.put(None)
+        self.thread.join()
+        self._check()
+
+
+def stored_fingerprint(out, name):
+    return (out.metadata(name) or {}).get("fingerprint")
+
+
+def plan_tables(out, datasets, tables, force=False):
+    """Work out which tables are stale: those whose fingerprint (of source
+    files, configs and code) differs from the one stored with them, or can't
+    be computed. Returns {table_name: fingerprint} for tables to rebuild."""
+    stale = {}
+
+    # Hashing a changed source file reads all of it, so the (NFS) reads are
+    # done at the same time rather than one by one before the pool starts
+    required = sorted(set(requirement for table in tables.values()
+                          for requirement in table_requirements(table)))
+    with concurrent.futures.ThreadPoolExecutor(FINGERPRINT_THREADS) as executor:
+        dataset_fingerprints = dict(zip(required, executor.map(
+            lambda name: fingerprints.dataset_fingerprint(datasets[name]),
+            required)))
+
+    for table_name, table in tables.items():
+        requirements = table_requirements(table)
+        fingerprint = fingerprints.table_fingerprint(
+            table, {r: dataset_fingerprints[r] for r in requirements})
+
+        if force or fingerprint is None or \
+                stored_fingerprint(out, table_name) != fingerprint:
+            stale[table_name] = fingerprint
+
+    return stale
+
+
+def check_graph(datasets, tables):
+    for table_name, table in tables.items():
+        for requirement in table_requirements(table):
+            if requirement not in datasets:
+                raise ValueError("Table {} requires unknown dataset {}"
+                                 .format(table_name, requirement))
+
+
+def run_pipeline(datasets, tables, output_path, processes=None,
+                 complib="blosc", force=False, report_prefix=None):
+    """Process datasets in a pool of worker processes and write each table to
+    the output (an HDF store or Parquet directory, see output.open_output) as
+    soon as all the datasets it requires are done.
+
+    Independent datasets run concurrently, while the parent process is the
+    only one that writes output, on a background thread (see
+    BackgroundWriter) so that writes overlap collecting the next results.
+    Dataset results are dropped once no pending table needs them anymore.
+    Per table HDF layout settings come from "hdf_layout" in the dataset or
+    table dicts.
+
+    Tables that are already in the store with an up to date fingerprint are
+    skipped, along with any datasets that only they need, unless force is
+    set.
+
+    If report_prefix is given, per-stage timings of every dataset are written
+    to report_prefix.json and report_prefix.csv."""
+
+    check_graph(datasets, tables)
+
+    if processes is None:
+        processes = os.cpu_count() or 1
+
+    _DATASETS.clear()
+    _DATASETS.update(datasets)
+
+    # Build classification indexes once here so forked workers share them
+    classification_cache.warm(datasets)
+
+    out = output.open_output(output_path, complib=complib)
+    results = {}
+    records = []
+    writer = None
+
+    def write_ready_tables():
+        for table_name, table in list(pending_tables.items()):
+            requirements = table_requirements(table)
+            if not all(r in results for r in requirements):
+                continue
+
+            good("Queueing table: {}".format(table_name))
+            attrs = dict(table.get("attrs", {}))
+            attrs["fingerprint"] = stale[table_name]
+            writer.put(table_name, table, {r: results[r] for r in requirements},
+                       attrs, table_layout(table, datasets))
+            del pending_tables[table_name]
+
+        # Free results that nothing pending depends on anymore
+        still_needed = set()
+        for table in pending_tables.values():
+            still_needed.update(table_requirements(table))
+        for name in list(results.keys()):
+            if name not in still_needed:
+                del results[name]
+
+    try:
+        stale = plan_tables(out, datasets, tables, force=force)
+        for table_name in tables:
+            if table_name not in stale:
+                good("Table {} is up to date.".format(table_name))
+
+        pending_tables = {name: tables[name] for name in stale}
+
+        needed = set()
+        for table in pending_tables.values():
+            needed.update(table_requirements(table))
+
+        with concurrent.futures.ProcessPoolExecutor(
+                processes,
+                mp_context=multiprocessing.get_context("fork")) as executor:
+            futures = {
+                executor.submit(_process_named_dataset, name): name
+                for name in datasets
+                if name in needed
+            }
+
+            # Only start the writer thread once the workers are forked,
+            # forking while it holds a lock (even stdout's) could deadlock
+            # them
+            writer = BackgroundWriter(out)
+
+            # Tables that need no datasets (e.g. classifications) go first
+            write_ready_tables()
+
+            for future in concurrent.futures.as_completed(futures):
+                name = futures[future]
+                try:
+                    results[name], dataset_records = future.result()
+                    records.extend(dataset_records)
+                except Exception:
+                    bad("Dataset {} failed!".format(name))
+                    raise
+
+                good("Dataset {} finished.".format(name))
+                write_ready_tables()
+
+        writer.join()
+    finally:
+        if writer is not None and writer.thread.is_alive():
+            # Failed before the writer was done, let it finish what it has
+            # so the store can be closed cleanly
+            writer.queue.put(None)
+            writer.thread.join()
+        if writer is not None:
+            records.extend(writer.records)
+        out.close()
+        if report_prefix is not None and records:
+            instrumentation.write_report(records, report_prefix)
@@ -0,0 +1,406 @@
+"""Publish the generated downloads to S3 as a new release.
+
+    python publish.py downloads/ s3://datlas-peru-downloads --profile datlas-peru-downloads-prod
+    python publish.py downloads/ /tmp/fake-bucket
+
+Files are stored by content hash under objects/, so only files that changed
+since any earlier release get uploaded. Each release is a manifest under
+releases/ mapping download names to objects (plus the manually uploaded
+files under custom/). Promoting a release copies changed files into
+production/ before removing the ones that went away, and then points
+production.json at the new manifest, so production is never empty."""
+
+import os
+import json
+import shutil
+import logging
+import hashlib
+import datetime
+import mimetypes
+import subprocess
+import concurrent.futures
+
+try:
+    import boto3
+except ImportError:
+    boto3 = None
+
+
+# A deploy tool, so plain logging rather than dataset_tools' clint helpers,
+# which would pull in the whole ingestion stack
+log = logging.getLogger("publish")
+
+
+GENERATED_PREFIX = "objects/"
+CUSTOM_PREFIX = "custom/"
+RELEASES_PREFIX = "releases/"
+PRODUCTION_PREFIX = "production/"
+POINTER_KEY = "production.json"
+
+GZIP_MAGIC = b"\x1f\x8b"
+
+# Parallel uploads / copies
+DEFAULT_WORKERS = 16
+
+
+def file_hash(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def is_gzipped(path):
+    with open(path, "rb") as f:
+        return f.read(2) == GZIP_MAGIC
+
+
+def guess_content_type(name):
+    return mimetypes.guess_type(name)[0] or "application/octet-stream"
+
+
+def object_metadata(name, path):
+    """Content type and encoding of a download. Our CSVs are gzipped, so
+    browsers need the Content-Encoding to decode them."""
+    encoding = "gzip" if is_gzipped(path) and not name.endswith(".gz") else None
+    return {"content_type": guess_content_type(name),
+            "content_encoding": encoding}
+
+
+def version_string():
+    """yyyy-mm-dd-<latest git tag>, the default release name."""
+    tag = subprocess.check_output(["git", "describe", "--tags"])
+    return "{}-{}".format(datetime.date.today().isoformat(),
+                          tag.decode("utf-8").strip())
+
+
+class LocalStore(object):
+    """A directory standing in for a bucket. Object metadata is kept next to
+    the objects, under .metadata/."""
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.root, *key.split("/"))
+
+    def _metadata_path(self, key):
+        return os.path.join(self.root, ".metadata", *key.split("/")) + ".json"
+
+    def _write(self, key, write_function, metadata):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + ".tmp.{}".format(os.getpid())
+        write_function(tmp_path)
+        os.replace(tmp_path, path)
+
+        metadata_path = self._metadata_path(key)
+        os.makedirs(os.path.dirname(metadata_path), exist_ok=True)
+        with open(metadata_path, "w") as f:
+            json.dump(metadata, f)
+
+    def exists(self, key):
+        return os.path.exists(self._path(key))
+
+    def list(self, prefix):
+        keys = []
+        base = self._path(prefix)
+        for directory, _, files in os.walk(base):
+            for file_name in files:
+                path = os.path.join(directory, file_name)
+                keys.append("/".join(
+                    os.path.relpath(path, self.root).split(os.sep)))
+        return sorted(keys)
+
+    def fingerprint(self, key):
+        return file_hash(self._path(key))
+
+    def metadata(self, key):
+        try:
+            with open(self._metadata_path(key)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def get(self, key):
+        try:
+            with open(self._path(key), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def put(self, key, data, content_type=None, content_encoding=None,
+            public=False):
+        def write(path):
+            with open(path, "wb") as f:
+                f.write(data)
+        self._write(key, write, {"content_type": content_type,
+                                 "content_encoding": content_encoding,
+                                 "public": public})
+
+    def upload(self, key, path, content_type=None, content_encoding=None,
+               public=False):
+        self._write(key, lambda tmp_path: shutil.copyfile(path, tmp_path),
+                    {"content_type": content_type,
+                     "content_encoding": content_encoding,
+                     "public": public})
+
+    def copy(self, source_key, key, content_type=None, content_encoding=None,
+             public=False):
+        self.upload(key, self._path(source_key), content_type,
+                    content_encoding, public)
+
+    def delete(self, key):
+        for path in [self._path(key), self._metadata_path(key)]:
+            if os.path.exists(path):
+                os.remove(path)
+
+
+class S3Store(object):
+    """A prefix of an S3 bucket. Metadata is always set explicitly on
+    uploads and copies, so multipart transfers can't lose it."""
+
+    def __init__(self, url, profile=None, endpoint_url=None):
+        if boto3 is None:
+            raise ImportError("Publishing to S3 needs boto3 installed.")
+        bucket, _, prefix = url[len("s3://"):].partition("/")
+        self.bucket = bucket
+        self.prefix = prefix.strip("/") + "/" if prefix.strip("/") else ""
+        session = boto3.session.Session(profile_name=profile)
+        self.client = session.client("s3", endpoint_url=endpoint_url)
+
+    def _key(self, key):
+        return self.prefix + key
+
+    @staticmethod
+    def _extra_args(content_type, content_encoding, public):
+        args = {}
+        if content_type:
+            args["ContentType"] = content_type
+        if content_encoding:
+            args["ContentEncoding"] = content_encoding
+        if public:
+            args["ACL"] = "public-read"
+        return args
+
+    def exists(self, key):
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self._key(key))
+            return True
+        except self.client.exceptions.ClientError:
+            return False
+
+    def list(self, prefix):
+        keys = []
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket,
+                                       Prefix=self._key(prefix)):
+            for obj in page.get("Contents", []):
+                keys.append(obj["Key"][len(self.prefix):])
+        return sorted(keys)
+
+    def fingerprint(self, key):
+        head = self.client.head_object(Bucket=self.bucket, Key=self._key(key))
+        return head["ETag"].strip('"')
+
+    def metadata(self, key):
+        head = self.client.head_object(Bucket=self.bucket, Key=self._key(key))
+        return {"content_type": head.get("ContentType"),
+                "content_encoding": head.get("ContentEncoding")}
+
+    def get(self, key):
+        try:
+            response = self.client.get_object(Bucket=self.bucket,
+                                              Key=self._key(key))
+        except self.client.exceptions.NoSuchKey:
+            return None
+        return response["Body"].read()
+
+    def put(self, key, data, content_type=None, content_encoding=None,
+            public=False):
+        self.client.put_object(
+            Bucket=self.bucket, Key=self._key(key), Body=data,
+            **self._extra_args(content_type, content_encoding, public))
+
+    def upload(self, key, path, content_type=None, content_encoding=None,
+               public=False):
+        self.client.upload_file(
+            path, self.bucket, self._key(key),
+            ExtraArgs=self._extra_args(content_type, content_encoding, public))
+
+    def copy(self, source_key, key, content_type=None, content_encoding=None,
+             public=False):
+        extra_args = self._extra_args(content_type, content_encoding, public)
+        extra_args["MetadataDirective"] = "REPLACE"
+        self.client.copy({"Bucket": self.bucket, "Key": self._key(source_key)},
+                         self.bucket, self._key(key), ExtraArgs=extra_args)
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=self._key(key))
+
+
+def open_store(url, **kwargs):
+    if url.startswith("s3://"):
+        return S3Store(url, **kwargs)
+    return LocalStore(url)
+
+
+def _map(workers, f, items):
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        return list(executor.map(f, items))
+
+
+def build_manifest(store, source_dir, workers=DEFAULT_WORKERS):
+    """{download name: entry} for every file in source_dir and the custom
+    files already in the store. Entries name the object holding the file,
+    its content hash and its metadata."""
+    paths = {}
+    for directory, _, files in os.walk(source_dir):
+        for file_name in files:
+            path = os.path.join(directory, file_name)
+            name = "/".join(os.path.relpath(path, source_dir).split(os.sep))
+            paths[name] = path
+
+    def generated_entry(name):
+        digest = file_hash(paths[name])
+        entry = {"key": GENERATED_PREFIX + digest, "hash": digest}
+        entry.update(object_metadata(name, paths[name]))
+        return name, entry
+
+    def custom_entry(key):
+        name = key[len(CUSTOM_PREFIX):]
+        metadata = store.metadata(key)
+        return name, {
+            "key": key,
+            "hash": store.fingerprint(key),
+            "content_type": (metadata.get("content_type") or
+                             guess_content_type(name)),
+            "content_encoding": metadata.get("content_encoding"),
+        }
+
+    manifest = dict(_map(workers, generated_entry, sorted(paths)))
+
+    # Manually uploaded files complete the downloads
+    for name, entry in _map(workers, custom_entry, store.list(CUSTOM_PREFIX)):
+        if name in manifest:
+            log.warning("Custom file {} replaces the generated one.".format(name))
+        manifest[name] = entry
+
+    return manifest, paths
+
+
+def upload_objects(store, manifest, paths, workers=DEFAULT_WORKERS):
+    """Upload generated files whose content isn't in the store yet. Returns
+    the names that were uploaded."""
+    def upload(name):
+        entry = manifest[name]
+        if store.exists(entry["key"]):
+            return None
+        store.upload(entry["key"], paths[name], entry["content_type"],
+                     entry["content_encoding"])
+        return name
+
+    generated = [name for name, entry in sorted(manifest.items())
+                 if entry["key"].startswith(GENERATED_PREFIX)]
+    return [name for name in _map(workers, upload, generated) if name]
+
+
+def production_manifest(store):
+    pointer = store.get(POINTER_KEY)
+    if pointer is None:
+        return {}
+    release_key = json.loads(pointer.decode("utf-8"))["release"]
+    return json.loads(store.get(release_key).decode("utf-8"))
+
+
+def promote(store, version, workers=DEFAULT_WORKERS):
+    """Make a release the production one. New and changed files are copied
+    into production/ first, files that aren't in the release are removed
+    after, and production.json is switched last."""
+    release_key = RELEASES_PREFIX + version + ".json"
+    manifest = json.loads(store.get(release_key).decode("utf-8"))
+    current = production_manifest(store)
+
+    def changed(name):
+        old = current.get(name)
+        return old is None or old["hash"] != manifest[name]["hash"] or \
+            not store.exists(PRODUCTION_PREFIX + name)
+
+    def copy(name):
+        entry = manifest[name]
+        store.copy(entry["key"], PRODUCTION_PREFIX + name,
+                   entry["content_type"], entry["content_encoding"],
+                   public=True)
+
+    to_copy = [name for name in sorted(manifest) if changed(name)]
+    _map(workers, copy, to_copy)
+
+    stale = [key for key in store.list(PRODUCTION_PREFIX)
+             if key[len(PRODUCTION_PREFIX):] not in manifest]
+    _map(workers, store.delete, stale)
+
+    store.put(POINTER_KEY,
+              json.dumps({"release": release_key}).encode("utf-8"),
+              content_type="application/json", public=True)
+    return to_copy, stale
+
+
+def publish(store, source_dir, version, workers=DEFAULT_WORKERS,
+            promote_release=True):
+    """Upload the downloads in source_dir as a release and (by default)
+    promote it to production."""
+    manifest, paths = build_manifest(store, source_dir, workers)
+    uploaded = upload_objects(store, manifest, paths, workers)
+    log.info("Uploaded {} of {} files, the rest were unchanged.".format(
+        len(uploaded), len(paths)))
+
+    release_key = RELEASES_PREFIX + version + ".json"
+    store.put(release_key,
+              json.dumps(manifest, indent=2, sort_keys=True).encode("utf-8"),
+              content_type="application/json")
+    log.info("Wrote release {}.".format(release_key))
+
+    if promote_release:
+        copied, removed = promote(store, version, workers)
+        log.info("Promoted {} to production ({} files updated, {} removed)."
+             .format(version, len(copied), len(removed)))
+
+    return manifest
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("source", help="Folder of downloads to publish, e.g. downloads/")
+    parser.add_argument("destination",
+                        help="s3://bucket[/prefix], or a local folder to publish into")
+    parser.add_argument("--profile", help="awscli credentials profile to use")
+    parser.add_argument("--endpoint-url",
+                        help="S3 compatible endpoint to use instead of AWS")
+    parser.add_argument("--version", default=None,
+                        help="Release name (default: yyyy-mm-dd-<git tag>)")
+    parser.add_argument("-j", "--workers", type=int, default=DEFAULT_WORKERS,
+                        help="Parallel uploads (default: {})".format(DEFAULT_WORKERS))
+    parser.add_argument("--no-promote", action="store_true",
+                        help="Upload the release without switching production to it")
+    parser.add_argument("--promote", metavar="VERSION",
+                        help="Only switch production to an existing release")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    kwargs = {}
+    if args.destination.startswith("s3://"):
+        kwargs = {"profile": args.profile, "endpoint_url": args.endpoint_url}
+    store = open_store(args.destination, **kwargs)
+
+    if args.promote:
+        copied, removed = promote(store, args.promote, args.workers)
+        log.info("Promoted {} to production ({} files updated, {} removed)."
+             .format(args.promote, len(copied), len(removed)))
+    else:
+        publish(store, args.source, args.version or version_string(),
+                args.workers, promote_release=not args.no_promote)
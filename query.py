@@ -0,0 +1,244 @@
+"""Slice queries over the built tables, like "location X, all products, year
+Y", without reading whole tables.
+
+    q = FacetQuery("data.h5")
+    q.slice("department_product_year", location_id=5, year=2014)
+
+The first time a table is queried it's read once and saved, sorted by each
+of its (id, year) keys, as one .npy file per column under the query cache.
+Queries binary search the sorted keys and read just that range of rows from
+the memory mapped columns. Recent slices are kept in a size-bounded LRU.
+The saved copies are keyed on the table's fingerprint, so rebuilding a
+table invalidates them."""
+
+import os
+import json
+import shutil
+import hashlib
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+import output
+
+
+CACHE_DIR = os.environ.get(
+    "PERU_INGESTION_QUERY_CACHE_DIR",
+    os.path.join(os.path.expanduser("~"), ".cache", "peru-ingestion", "query"))
+
+# Bytes of query results kept in memory
+DEFAULT_CACHE_BYTES = 256 * 1024 * 1024
+
+# Id columns that tables get sorted by, each followed by year
+SORT_COLUMNS = ["location_id", "product_id", "country_id"]
+YEAR_COLUMN = "year"
+
+# Keys are id * YEAR_RADIX + year
+YEAR_RADIX = 1 << 16
+
+
+def sort_orders(columns):
+    """The (id, year) orders a table with these columns is indexed by."""
+    orders = []
+    for column in SORT_COLUMNS:
+        if column in columns:
+            if YEAR_COLUMN in columns:
+                orders.append((column, YEAR_COLUMN))
+            else:
+                orders.append((column,))
+    return orders
+
+
+def combined_key(df, order):
+    key = df[order[0]].values.astype(np.int64)
+    if len(order) > 1:
+        key = key * YEAR_RADIX + df[order[1]].values.astype(np.int64)
+    return key
+
+
+def _save_column(directory, column, values):
+    path = os.path.join(directory, column + ".npy")
+    np.save(path, values, allow_pickle=values.dtype == object)
+
+
+def _load_column(directory, column):
+    path = os.path.join(directory, column + ".npy")
+    try:
+        return np.load(path, mmap_mode="r")
+    except ValueError:
+        # Object (e.g. string) columns can't be memory mapped
+        return np.load(path, allow_pickle=True)
+
+
+class SortedTable(object):
+    """One table saved sorted by one order: the combined key of each row
+    and every column, memory mapped."""
+
+    def __init__(self, directory):
+        with open(os.path.join(directory, "columns.json")) as f:
+            self.columns = json.load(f)
+        self.key = _load_column(directory, "__key__")
+        self.values = OrderedDict(
+            (column, _load_column(directory, "{:04d}".format(i)))
+            for i, column in enumerate(self.columns))
+
+    @staticmethod
+    def build(directory, df, order):
+        """Save df sorted by order into directory, atomically."""
+        tmp_dir = directory + ".tmp.{}".format(os.getpid())
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+
+        key = combined_key(df, order)
+        sort = np.argsort(key, kind="mergesort")
+        _save_column(tmp_dir, "__key__", key[sort])
+        for i, column in enumerate(df.columns):
+            _save_column(tmp_dir, "{:04d}".format(i), df[column].values[sort])
+        with open(os.path.join(tmp_dir, "columns.json"), "w") as f:
+            json.dump(list(df.columns), f)
+
+        try:
+            os.rename(tmp_dir, directory)
+        except OSError:
+            # Someone else built it first
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def rows(self, low, high):
+        """Positions of the rows with low <= key < high."""
+        return (int(np.searchsorted(self.key, low, side="left")),
+                int(np.searchsorted(self.key, high, side="left")))
+
+    def frame(self, start, stop, columns=None):
+        columns = columns or self.columns
+        return pd.DataFrame(OrderedDict(
+            (column, np.array(self.values[column][start:stop]))
+            for column in columns), columns=columns)
+
+
+class LRUCache(object):
+    """Query results, evicting the least recently used past max_bytes."""
+
+    def __init__(self, max_bytes=DEFAULT_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        if key not in self.entries:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return self.entries[key][0]
+
+    def put(self, key, df):
+        size = int(df.memory_usage(deep=True).sum())
+        if size > self.max_bytes:
+            return
+        if key in self.entries:
+            self.bytes -= self.entries.pop(key)[1]
+        self.entries[key] = (df, size)
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            _, (_, evicted_size) = self.entries.popitem(last=False)
+            self.bytes -= evicted_size
+
+    def clear(self):
+        self.entries.clear()
+        self.bytes = 0
+
+
+class FacetQuery(object):
+    """Slice queries over the tables of a build output (an HDF store or
+    Parquet directory). Results come from a shared cache, so callers
+    shouldn't modify them."""
+
+    def __init__(self, data_path, cache_dir=None, cache_bytes=DEFAULT_CACHE_BYTES):
+        self.data_path = data_path
+        self.cache_dir = cache_dir or CACHE_DIR
+        self.cache = LRUCache(cache_bytes)
+        self._tables = {}
+
+    def _table_dir(self, data, name):
+        fingerprint = (data.metadata(name) or {}).get("fingerprint")
+        if fingerprint is None:
+            # Not built by the pipeline, fall back on the file's mtime
+            st = os.stat(self.data_path)
+            fingerprint = "{}:{}".format(os.path.abspath(self.data_path),
+                                         st.st_mtime_ns)
+        token = hashlib.sha1("{}:{}".format(name, fingerprint)
+                             .encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, token)
+
+    def _sorted_tables(self, name):
+        """{order: SortedTable} for a table, saving them on first use."""
+        name = output._normalize_name(name)
+        if name not in self._tables:
+            data = output.open_output(self.data_path, mode="r")
+            try:
+                table_dir = self._table_dir(data, name)
+                df = None
+                tables = {}
+                for order in sort_orders(self._columns(data, name)):
+                    directory = os.path.join(table_dir, "-".join(order))
+                    if not os.path.exists(directory):
+                        if df is None:
+                            df = data.read(name)
+                        os.makedirs(table_dir, exist_ok=True)
+                        SortedTable.build(directory, df, order)
+                    tables[order] = SortedTable(directory)
+            finally:
+                data.close()
+            self._tables[name] = tables
+        return self._tables[name]
+
+    @staticmethod
+    def _columns(data, name):
+        return list(next(iter(data.read_chunks(name, 1))).columns)
+
+    def slice(self, name, columns=None, **filters):
+        """Rows of a table where each of the filters (column=value) matches,
+        e.g. slice("msa_product_year", location_id=3, year=2010). One of the
+        filters has to be an id column the table is sorted by."""
+        key = (output._normalize_name(name),
+               tuple(columns) if columns else None,
+               tuple(sorted(filters.items())))
+        cached = self.cache.get(key)
+        if cached is not None:
+            return cached
+
+        tables = self._sorted_tables(name)
+        for order, table in tables.items():
+            if order[0] in filters:
+                break
+        else:
+            raise ValueError("{} can only be sliced by {}".format(
+                name, [order[0] for order in tables]))
+
+        first = int(filters[order[0]])
+        if len(order) > 1 and order[1] in filters:
+            low = first * YEAR_RADIX + int(filters[order[1]])
+            high = low + 1
+        else:
+            low = first * YEAR_RADIX if len(order) > 1 else first
+            high = (first + 1) * YEAR_RADIX if len(order) > 1 else first + 1
+
+        start, stop = table.rows(low, high)
+        df = table.frame(start, stop, columns and list(
+            columns) + [c for c in filters if c not in columns])
+
+        # Filters that the sort order didn't cover
+        rest = {c: v for c, v in filters.items() if c not in order}
+        if rest:
+            mask = np.ones(len(df), dtype=bool)
+            for column, value in rest.items():
+                mask &= df[column].values == value
+            df = df[mask].reset_index(drop=True)
+        if columns:
+            df = df[list(columns)]
+
+        self.cache.put(key, df)
+        return df
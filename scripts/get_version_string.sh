@@ -1 +0,0 @@
-echo "$(date +%F)-$(git describe --tags)"
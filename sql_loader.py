@@ -0,0 +1,263 @@
+"""Load the tables in data.h5 that have a sql_table_name into a database.
+
+    python sql_loader.py data.h5 --sqlite atlas.db --create
+    python sql_loader.py data.h5 --postgres "dbname=atlas" -j 4 --truncate
+
+Tables are streamed out of the store in chunks and bulk inserted, with COPY
+on Postgres and executemany batches on anything else. Independent tables
+load at the same time in worker processes, each holding one connection."""
+
+import io
+import os
+import sys
+import time
+import multiprocessing
+import concurrent.futures
+
+import pandas as pd
+
+import output
+from dataset_tools import good, bad, warn, MODEL_COLUMNS
+
+
+# Rows read from the store and inserted at a time
+CHUNKSIZE = 100000
+
+# Columns named differently in the store than in the database
+COLUMN_RENAMES = {"index": "id"}
+
+# Tables under here hold the raw linnaeus columns of a classification, which
+# are loaded as the model attributes in MODEL_COLUMNS
+CLASSIFICATIONS_PREFIX = "/classifications/"
+
+
+def database_columns(key, df):
+    """df with its columns named as in the database table."""
+    if not output._normalize_name(key).startswith(CLASSIFICATIONS_PREFIX):
+        return df.rename(columns=COLUMN_RENAMES)
+    columns = [c for c in df.columns if c in COLUMN_RENAMES or c in MODEL_COLUMNS]
+    renames = dict(COLUMN_RENAMES, **MODEL_COLUMNS)
+    return df[columns].rename(columns=renames)
+
+
+def discover_tables(data):
+    """{table in the store: sql table name} for tables that should be
+    loaded."""
+    tables = {}
+    for key in data.tables():
+        metadata = data.metadata(key) or {}
+        if "sql_table_name" in metadata:
+            tables[key] = metadata["sql_table_name"]
+    return tables
+
+
+def paramstyle(connection):
+    """The DB-API paramstyle of the module a connection came from."""
+    module = sys.modules[type(connection).__module__.split(".")[0]]
+    return getattr(module, "paramstyle", "qmark")
+
+
+def placeholders(connection, n):
+    style = paramstyle(connection)
+    if style == "qmark":
+        return ", ".join(["?"] * n)
+    if style in ("format", "pyformat"):
+        return ", ".join(["%s"] * n)
+    raise ValueError("Unsupported paramstyle {}".format(style))
+
+
+def sql_type(dtype):
+    if pd.api.types.is_integer_dtype(dtype) or pd.api.types.is_bool_dtype(dtype):
+        return "BIGINT"
+    if pd.api.types.is_float_dtype(dtype):
+        return "DOUBLE PRECISION"
+    return "TEXT"
+
+
+def create_table(cursor, sql_table_name, df):
+    """Create a table with columns like df's. The API database gets its
+    schema from the models, this is for loading into scratch databases."""
+    columns = ", ".join("{} {}".format(column, sql_type(dtype))
+                        for column, dtype in df.dtypes.items())
+    cursor.execute("CREATE TABLE IF NOT EXISTS {} ({})"
+                   .format(sql_table_name, columns))
+
+
+def whole_floats_to_int(df):
+    """Float columns that only hold whole numbers (and missing values), like
+    ids with a NaN, as nullable integers. Otherwise to_csv writes them as 1.0,
+    which COPY won't load into an integer column."""
+    for column in df.columns:
+        values = df[column]
+        if pd.api.types.is_float_dtype(values):
+            present = values.dropna()
+            if (present == present.round()).all() and \
+                    (present.abs() < 2 ** 63).all():
+                df[column] = values.astype("Int64")
+    return df
+
+
+def insert_chunk(connection, cursor, sql_table_name, df):
+    columns = ", ".join(df.columns)
+
+    if hasattr(cursor, "copy_expert"):
+        # psycopg2: COPY the chunk as CSV, empty fields are NULL
+        buffer = io.StringIO()
+        whole_floats_to_int(df.copy()).to_csv(buffer, header=False, index=False)
+        buffer.seek(0)
+        cursor.copy_expert("COPY {} ({}) FROM STDIN WITH CSV"
+                           .format(sql_table_name, columns), buffer)
+        return
+
+    rows = df.astype(object).where(df.notnull(), None).values.tolist()
+    cursor.executemany("INSERT INTO {} ({}) VALUES ({})".format(
+        sql_table_name, columns, placeholders(connection, len(df.columns))),
+        rows)
+
+
+class Loader(object):
+    """Streams tables from a data store into a database. connect is a
+    function returning a new DB-API connection; like the data store, one is
+    opened per process."""
+
+    def __init__(self, data_path, connect, create=False, truncate=False,
+                 chunksize=CHUNKSIZE):
+        self.data_path = data_path
+        self.connect = connect
+        self.create = create
+        self.truncate = truncate
+        self.chunksize = chunksize
+        self._pid = None
+        self._data = None
+        self._connection = None
+
+    def _open(self):
+        if self._pid != os.getpid():
+            self._data = output.open_output(self.data_path, mode="r")
+            self._connection = self.connect()
+            self._pid = os.getpid()
+
+    def close(self):
+        if self._pid == os.getpid():
+            self._data.close()
+            self._connection.close()
+        self._pid = self._data = self._connection = None
+
+    def tables(self):
+        self._open()
+        return discover_tables(self._data)
+
+    def load(self, key, sql_table_name):
+        """Load one table in a single transaction. Returns the number of
+        rows inserted and how long it took."""
+        self._open()
+        start = time.time()
+        rows = 0
+
+        cursor = self._connection.cursor()
+        try:
+            chunks = self._data.read_chunks(key, self.chunksize)
+            for i, chunk in enumerate(chunks):
+                chunk = database_columns(key, chunk)
+                if i == 0:
+                    if self.create:
+                        create_table(cursor, sql_table_name, chunk)
+                    if self.truncate:
+                        cursor.execute("DELETE FROM {}".format(sql_table_name))
+                insert_chunk(self._connection, cursor, sql_table_name, chunk)
+                rows += len(chunk)
+            self._connection.commit()
+        except Exception:
+            self._connection.rollback()
+            raise
+        finally:
+            cursor.close()
+
+        return rows, time.time() - start
+
+
+# Set in the parent before workers are forked
+_LOADER = None
+
+
+def load_table(key, sql_table_name):
+    return _LOADER.load(key, sql_table_name)
+
+
+def load_all(loader, tables=None, processes=None):
+    """Load tables ({store key: sql table name}, all that have one by
+    default), several at once. Returns {sql table name: (rows, seconds)}."""
+    global _LOADER
+    _LOADER = loader
+    if tables is None:
+        tables = loader.tables()
+        loader.close()
+
+    results = {}
+    # Workers have to be forked to inherit _LOADER
+    with concurrent.futures.ProcessPoolExecutor(
+            processes,
+            mp_context=multiprocessing.get_context("fork")) as executor:
+        futures = {
+            executor.submit(load_table, key, sql_table_name): sql_table_name
+            for key, sql_table_name in tables.items()
+        }
+        for future in concurrent.futures.as_completed(futures):
+            sql_table_name = futures[future]
+            try:
+                rows, seconds = future.result()
+            except Exception:
+                bad("Loading {} failed!".format(sql_table_name))
+                raise
+            good("Loaded {} ({} rows in {:.1f}s, {:.0f} rows/s)."
+                 .format(sql_table_name, rows, seconds,
+                         rows / seconds if seconds else 0))
+            results[sql_table_name] = (rows, seconds)
+    return results
+
+
+if __name__ == "__main__":
+    import argparse
+    import functools
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("data", nargs="?", default="data.h5",
+                        help="data.h5 or a Parquet output directory (default: data.h5)")
+    database = parser.add_mutually_exclusive_group(required=True)
+    database.add_argument("--sqlite", help="Path of a SQLite database")
+    database.add_argument("--postgres", help="libpq connection string")
+    parser.add_argument("-j", "--processes", type=int, default=None,
+                        help="Number of tables to load at once (default: number of CPUs)")
+    parser.add_argument("--only", nargs="+",
+                        help="Only load these sql tables")
+    parser.add_argument("--create", action="store_true",
+                        help="Create missing tables from the column types")
+    parser.add_argument("--truncate", action="store_true",
+                        help="Empty each table before loading it")
+    args = parser.parse_args()
+
+    if args.sqlite:
+        import sqlite3
+        connect = functools.partial(sqlite3.connect, args.sqlite, timeout=600)
+        if args.processes is None:
+            # SQLite only has one writer at a time anyway
+            args.processes = 1
+    else:
+        import psycopg2
+        connect = functools.partial(psycopg2.connect, args.postgres)
+
+    loader = Loader(args.data, connect, create=args.create,
+                    truncate=args.truncate)
+    tables = loader.tables()
+    loader.close()
+    if args.only:
+        missing = set(args.only) - set(tables.values())
+        if missing:
+            warn("No tables in {} for {}".format(args.data, sorted(missing)))
+        tables = {key: name for key, name in tables.items() if name in args.only}
+
+    start = time.time()
+    results = load_all(loader, tables, args.processes)
+    total_rows = sum(rows for rows, _ in results.values())
+    good("Loaded {} tables, {} rows in {:.1f}s.".format(
+        len(results), total_rows, time.time() - start))
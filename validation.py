@@ -0,0 +1,167 @@
+"""Checks on a cleaned dataset before it's merged and aggregated: missing
+values, zero padding, duplicate entities, rectangularization and coverage by
+the classifications. All of them come out of one factorization of the facet
+fields instead of a separate scan each."""
+
+import os
+
+import numpy as np
+import pandas as pd
+
+
+LEVELS = ("full", "sampled", "off")
+
+# Default level for datasets that don't set "validation"
+DEFAULT_LEVEL = os.environ.get("PERU_INGESTION_VALIDATION", "full")
+
+# Rows checked at the "sampled" level
+SAMPLE_SIZE = 100000
+
+DUPLICATE_EXAMPLES = 10
+
+
+class ValidationReport(object):
+    """Results of validate(). Counts are of rows checked, which is a sample
+    of the dataset at the "sampled" level. rectangular and fill_ratio are
+    None when they weren't checked."""
+
+    def __init__(self, level, rows):
+        self.level = level
+        self.rows = rows
+        self.checked_rows = 0
+        self.null_counts = {}
+        self.padding_violations = {}
+        self.duplicate_rows = 0
+        self.duplicate_examples = None
+        self.rectangular = None
+        self.fill_ratio = None
+        self.coverage = {}
+
+    @property
+    def ok(self):
+        return (not any(self.null_counts.values()) and
+                not any(self.padding_violations.values()) and
+                self.duplicate_rows == 0 and
+                self.rectangular is not False and
+                not any(c["nonmatching_rows"] for c in self.coverage.values()))
+
+
+def factorize_codes(series):
+    """Integer codes and unique values of a column, reusing the existing
+    encoding if it's already categorical. Missing values are coded -1."""
+    if series.dtype.name == "category":
+        return series.cat.codes.values, np.asarray(series.cat.categories)
+    codes, uniques = pd.factorize(series)
+    return codes, np.asarray(uniques)
+
+
+def _zeropadding_violations(codes, uniques):
+    if len(uniques) == 0:
+        return 0
+
+    # Only look at each distinct value once
+    uniques = pd.Series(uniques, dtype=object)
+    is_string = uniques.map(lambda v: isinstance(v, str)).values
+    if not is_string.any():
+        return int((codes >= 0).sum())
+
+    strings = uniques[is_string].astype(str)
+    lengths = strings.str.len()
+    bad = np.ones(len(uniques), dtype=bool)
+    bad[is_string] = ~(strings.str.isdigit() &
+                       (lengths == lengths.mode().iloc[0])).values
+
+    valid_codes = codes[codes >= 0]
+    return int(bad[valid_codes].sum())
+
+
+def zeropadding_violations(series):
+    """Number of rows that aren't digit strings of the same length as most
+    of the others."""
+    return _zeropadding_violations(*factorize_codes(series))
+
+
+def combined_key(field_codes):
+    """Combine the integer codes of several fields into one int64 key per
+    row (missing values included), or None if it would overflow."""
+    radixes = [int(codes.max()) + 2 if len(codes) else 1
+               for codes in field_codes]
+    if np.prod([float(r) for r in radixes]) >= 2 ** 62:
+        return None
+
+    key = np.zeros(len(field_codes[0]), dtype=np.int64)
+    for codes, radix in zip(field_codes, radixes):
+        key = key * radix + (codes.astype(np.int64) + 1)
+    return key
+
+
+def validate(df, facet_fields, digit_padding=None, classification_lookups=None,
+             level=None, sample_size=None, seed=0):
+    """Run every check on df in one pass over its factorized facet fields.
+
+    classification_lookups maps fields to the (code index, ids) lookups from
+    classification_cache. At the "sampled" level only sample_size random rows
+    are checked and rectangularization isn't, at "off" nothing is."""
+    level = level or DEFAULT_LEVEL
+    if level not in LEVELS:
+        raise ValueError("Unknown validation level {}".format(level))
+
+    report = ValidationReport(level, len(df))
+    if level == "off":
+        return report
+
+    sample_size = sample_size or SAMPLE_SIZE
+    sampled = level == "sampled" and len(df) > sample_size
+    if sampled:
+        df = df.sample(n=sample_size, random_state=seed)
+    report.checked_rows = len(df)
+
+    factorized = {}
+    for field in set(facet_fields) | set(digit_padding or {}):
+        factorized[field] = factorize_codes(df[field])
+
+    for field in facet_fields:
+        report.null_counts[field] = int((factorized[field][0] < 0).sum())
+
+    for field in (digit_padding or {}):
+        report.padding_violations[field] = _zeropadding_violations(
+            *factorized[field])
+
+    # Duplicates and rectangularization from the combined key
+    field_codes = [factorized[field][0] for field in facet_fields]
+    key = combined_key(field_codes)
+    if key is None:
+        duplicated = df.duplicated(subset=list(facet_fields)).values
+    else:
+        duplicated = pd.Series(key).duplicated().values
+
+    report.duplicate_rows = int(duplicated.sum())
+    if report.duplicate_rows:
+        report.duplicate_examples = df[duplicated].head(DUPLICATE_EXAMPLES)
+
+    # A sample is almost never rectangular even if the dataset is, so these
+    # are left as None unless every row was checked
+    if not sampled:
+        possible = np.prod([float(len(factorized[field][1]))
+                            for field in facet_fields])
+        unique_keys = len(df) - report.duplicate_rows
+        report.fill_ratio = unique_keys / possible if possible else 0.0
+        report.rectangular = (unique_keys == possible and
+                              not any(report.null_counts.values()))
+
+    for field, (code_index, _) in (classification_lookups or {}).items():
+        codes, uniques = factorized.get(field) or factorize_codes(df[field])
+        uniques_matched = code_index.get_indexer(uniques) >= 0
+
+        matched = codes >= 0
+        matched[matched] = uniques_matched[codes[matched]]
+
+        report.coverage[field] = {
+            "nonmatching_rows": int((~matched).sum()),
+            "p_nonmatch_rows": 100.0 * (~matched).sum() / max(len(codes), 1),
+            "p_nonmatch_unique": 100.0 * (~uniques_matched).sum() / max(len(uniques), 1),
+            "codes_missing": pd.Series(uniques[~uniques_matched]),
+            "codes_unused": pd.Series(code_index[~code_index.isin(uniques)]),
+        }
+
+    return report